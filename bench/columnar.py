@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# check-files --batch against the per file comparison, over a synthetic state of a million entries
+# usage: python bench/columnar.py [entries], from the repository root, needs numpy
+import os
+import sys
+import time
+
+from collections import OrderedDict as odict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pacutil.columnar import ColumnarState, BatchComparer
+from pacutil.state import PkgState
+
+
+FILES_PER_PKG = 1000
+MODIFIED_EVERY = 1000
+
+
+def _state(n):
+    installed = odict()
+    state = odict()
+    for p in range(n // FILES_PER_PKG):
+        pkg = 'pkg-%s' % p
+        installed[pkg] = '1.0-1'
+        files = {'/usr/share/%s/%s/file-%s' % (pkg, i % 10, i): os.urandom(32) for i in range(FILES_PER_PKG)}
+        state[pkg] = PkgState({'1.0-1': files})
+    return installed, state
+
+
+def _scanned(installed, state):
+    # (pkg, version, path, hexdigest) as classify reports them, every MODIFIED_EVERY-th file changed
+    r = []
+    for pkg, version in installed.items():
+        paths = state[pkg].paths
+        for i, (node, d) in enumerate(state[pkg].digests(version).items()):
+            if i % MODIFIED_EVERY == 0:
+                d = bytes([d[0] ^ 0xff]) + d[1:]
+            r.append((pkg, version, paths.path(node), d.hex()))
+    return r
+
+
+def main(n):
+    installed, state = _state(n)
+    scanned = _scanned(installed, state)
+
+    t = time.perf_counter()
+    for pkg, version in installed.items():
+        state[pkg][version]
+    materialize_time = time.perf_counter() - t
+    t = time.perf_counter()
+    dict_modified = [(pkg, s) for pkg, version, s, h in scanned if state[pkg][version][s] != h]
+    dict_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    columnar = ColumnarState.from_state(installed, state)
+    build_time = time.perf_counter() - t
+    t = time.perf_counter()
+    comparer = BatchComparer(columnar)
+    for pkg, version, s, h in scanned:
+        comparer.add(pkg, s, h)
+    batch_modified = comparer.result()
+    batch_time = time.perf_counter() - t
+
+    assert sorted(batch_modified) == sorted(dict_modified)
+    print('%s entries, %s modified' % (len(scanned), len(dict_modified)))
+    print('hex dicts, needed by the index either way: %.3fs' % materialize_time)
+    print('per file compare:                          %.3fs' % dict_time)
+    print('columns from the binary state:             %.3fs' % build_time)
+    print('batched compare:                           %.3fs' % batch_time)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000 * 1000)
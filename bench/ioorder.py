@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# hashing time of a fragmented tree in each io order, and what --drop-cache leaves in the page cache
+# usage: python bench/ioorder.py [base dir], from the repository root
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pacutil import ioorder
+from pacutil.util import file_hash
+
+
+def _make_fragmented_tree(d, n, chunks, chunk_size):
+    # write all files a chunk at a time round robin, so their extents interleave on disk,
+    # with shuffled names so walk order is unrelated to on disk order
+    names = ['%06d' % i for i in range(n)]
+    random.Random(0).shuffle(names)
+    fds = []
+    for name in names:
+        sub = d / name[:2]
+        sub.mkdir(exist_ok=True)
+        fds.append(os.open(str(sub / name), os.O_WRONLY | os.O_CREAT, 0o644))
+    chunk = os.urandom(chunk_size)
+    for _ in range(chunks):
+        for fd in fds:
+            os.write(fd, chunk)
+    for fd in fds:
+        os.fsync(fd)
+        os.close(fd)
+
+
+def _evict(files):
+    for p in files:
+        fd = os.open(str(p), os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def bench(base=None, n=2000, chunks=4, chunk_size=64 * 1024):
+    d = Path(tempfile.mkdtemp(prefix='pacutil-ioorder-', dir=base))
+    try:
+        _make_fragmented_tree(d, n, chunks, chunk_size)
+        files = sorted(p for p in d.rglob('*') if p.is_file())
+        print('%s files of %s KiB below %s' % (n, chunks * chunk_size // 1024, d))
+        for order in ioorder.IO_ORDERS:
+            _evict(files)
+            t = time.perf_counter()
+            for p in ioorder.Ordered(files, order):
+                file_hash(p)
+            print('%-6s order: %.3fs' % (order, time.perf_counter() - t))
+        cached = files[:100]
+        _evict(cached)
+        for p in cached:
+            file_hash(p, drop_cache=True)
+        left = 0
+        for p in cached:
+            fd = os.open(str(p), os.O_RDONLY)
+            left += ioorder.resident(fd, os.fstat(fd).st_size)
+            os.close(fd)
+        print('files left in page cache after hashing cold files with drop_cache: %s/%s' % (left, len(cached)))
+    finally:
+        shutil.rmtree(str(d))
+
+
+if __name__ == '__main__':
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -1,3 +1,8 @@
 repo_path = '$HOME/etc-repo-hg'
 machine_repo_path = '$HOME/etc-$HOSTNAME'
 backup_repo_path = '$HOME/etc-$HOSTNAME-backup'
+aur_url = 'https://aur.archlinux.org'
+# url of a shared 'pacutil state-serve', None to compute all state locally
+state_server = None
+# shared secret of the state server and its clients, $PACUTIL_STATE_TOKEN takes precedence
+state_server_token = None
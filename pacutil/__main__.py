@@ -8,6 +8,7 @@ from pathlib import Path
 from collections import OrderedDict as odict
 
 import shutil
+import tempfile
 import os
 import sys
 
@@ -17,26 +18,47 @@ import re
 
 import argparse
 
+import asyncio
+
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
 import config
 
 import getpass
 
 from version import earlier_version
 
-import requests
-import re
-
-import urllib.parse
-
 import time
 
 from . import logging as log
 
 from . import color as col
 
-from .util import temp_dir, mkdir_p, check_call, check_output, copy_archive, file_hash, get_hash, handle_filepath, clean_glob
-from .util import chmod, filter_odict, startswith_any, is_system_file, natural_comp, ListComp
+from .util import temp_dir, mkdir_p, atomic_open, check_call, check_output, copy_archive_batch, file_hash, file_hashes_sudo, file_types_sudo, get_hash, handle_filepath
+from .util import chmod, filter_odict, is_system_file, natural_comp, ListComp
 from .util import hostname as machine
+from .util import get_cache_path
+from .pacman import PACMAN_LOCAL_DB, MODIFIED, UNMODIFIED, local_db_generation, pacman_get_versions, get_config_files, get_installed_pkgs, query_pacman
+from .pacman import ConfigFilesParser, parse
+from .pacmandb import LocalDb
+from .spool import Spool, STALE_AFTER
+from .spool import work as spool_run
+from . import state as pstate
+from .state import PkgState
+from .index import FileIndex, ReferenceCache, collect_files, iter_files, scan_files, classify_files, package_files, IndexException, MODIFIED_FILE, ORPHAN_FILE
+from .watch import Watcher, RESCAN_INTERVAL
+from .pathindex import PathIndex
+from .hashcache import HashCache
+from .pkgrepo import PkgRepo, share_working_copies, collect_share_tags, tag_escape, tag_name, tag_split
+from .ioorder import Ordered, IO_ORDERS
+from . import governor
+from .governor import Governor, parse_size
+from .daemon import Daemon, DaemonException, default_socket_path
+from .daemon import request as daemon_request
+from .chroot import ChrootPool, walk_files, make_accessible, chroot_file_hash
 from hg import hg as _hg
 
 hg = lambda repo_path: _hg(repo_path, log=log)
@@ -46,9 +68,7 @@ with Path('.pkg-blacklist').open('r') as f:
 
 
 INTERNAL_PKG_MARKER = '__'
-TAG_SEP = '#'
 BASE_BRANCH_NAME = 'base'
-BASE_TAG_NAME = '0'
 MACHINE_SEP = '!'
 FEATURE_SEP = '>'
 
@@ -85,79 +105,18 @@ PACMAN_DB_PATH = TMP_PATH / 'tmp-pacman'
 def get_state_path():
     return BASE_DIR / 'state' / arch
 
-MODIFIED = 0
-UNMODIFIED = 1
-PACMAN_CFG_FILE_LIST_CMD = ['pacman', '-Qii']
-
-
-def pacman_get_versions(chroot_path=None):
-    ls = check_output(PACMAN_CFG_FILE_LIST_CMD, universal_newlines=True, cwd=chroot_path).split('\n')
-    name_reg = re.compile(r'Name *: (.*)')
-    ver_reg = re.compile(r'Version *: (.*)')
-    name = None
-    ver = None
-    r = odict()
-    for l in ls:
-        m = name_reg.match(l)
-        if m:
-            name = m.group(1)
-        elif name:
-            m = ver_reg.match(l)
-            if m:
-                ver = m.group(1)
-                r[name] = ver
-    return r
-
-
-def get_config_files():
-    ls = check_output(PACMAN_CFG_FILE_LIST_CMD, universal_newlines=True).split('\n')
-    name_reg = re.compile(r'Name *: (.*)')
-    ver_reg = re.compile(r'Version *: (.*)')
-    f_reg = re.compile(r'((?:UN)?MODIFIED)[ \t]*(.*)')
-    name = None
-    ver = None
-    fs = []
-    r = odict()
-    for l in ls:
-        m = name_reg.match(l)
-        if m:
-            if name and fs:
-                assert(ver is not None)
-                r.setdefault(name, odict())
-                r[name].setdefault(ver, [])
-                r[name][ver] += fs
-                fs = []
-            name =m.group(1)
-        elif name:
-            m = ver_reg.match(l)
-            if m:
-                ver = m.group(1)
-            else:
-                m = f_reg.match(l)
-                if m:
-                    state = UNMODIFIED if m.group(1).startswith('UN') else MODIFIED
-                    fs.append((state, m.group(2)))
-    return r
-                
-            
-
 PACSTRAP_INSTALL_PKG = ['/usr/bin/pacstrap', '-c', '-G', '-M', '-d']
 
 
 def list_files(chroot_path):
-    pkg_files = chroot_path.glob('**/*')
-    pkg_files = [p.relative_to(chroot_path) for p in pkg_files]
+    pkg_files = walk_files(chroot_path)
     pkg_files = filter(lambda p: not is_system_file(p), pkg_files)
-    pkg_files = filter(lambda p: (chroot_path / p).is_file(), pkg_files)
     return pkg_files
 
 
 class PacmanException(Exception):
     pass
 
-class AurException(Exception):
-    pass
-
 
 def install_pkg(chroot_path, pkg, job, path=None):
     if path is None:
@@ -167,20 +126,12 @@ def install_pkg(chroot_path, pkg, job, path=None):
     assert(isinstance(pkg, str))
     assert(isinstance(path, str))
     #extract pkg
-    mkdir_p(chroot_path)
-    d = chroot_path / 'etc'
-    mkdir_p(d)
-    d = d / 'pacman.d'
-    mkdir_p(d)
     pacstrap_cmd = ['sudo'] + PACSTRAP_INSTALL_PKG + [str(chroot_path), pkg]
     try:
         check_call(['env', 'PATH=%s' % path] + pacstrap_cmd, stdout=DEVNULL)
     except subprocess.CalledProcessError as e:
         raise PacmanException(str(e))
 
-    d = str(chroot_path.absolute())
-    chmod('ugo=rwx', d, sudo=True)
-
     r = job(chroot_path)
 
     versions = pacman_get_versions(chroot_path)
@@ -188,63 +139,44 @@ def install_pkg(chroot_path, pkg, job, path=None):
     if pkg in versions:
         version = versions[pkg]
 
-    shutil.rmtree(d)
     return version, r
 
 
+_chroot_pool = None
+
+def chroot_pool():
+    global _chroot_pool
+    if _chroot_pool is None:
+        _chroot_pool = ChrootPool(CHROOT_PATH)
+    return _chroot_pool
+
+
+def install_pooled(install_f, pkg, job):
+    with chroot_pool().chroot() as chroot_path:
+        return install_f(chroot_path, pkg, job)
+
+
+def local_db(root=None):
+    # parsed pacman local db, only changed packages are parsed again
+    if root is None:
+        return LocalDb(get_cache_path() / 'pacman-local.snapshot')
+    name = 'pacman-local-%s.snapshot' % get_hash(str(Path(root).absolute()).encode('utf-8'))[:16]
+    return LocalDb(get_cache_path() / name, Path(root) / PACMAN_LOCAL_DB.relative_to('/'))
+
+
 def load_state():
-    state = odict()
-    state_path = get_state_path()
-    if state_path.exists():
-        for pkgf in state_path.glob('*.json'):
-            pkg = pkgf.stem
-            with pkgf.open('r') as f:
-                state[pkg] = json.load(f, object_pairs_hook=odict)
-    return state
+    return pstate.load_state(get_state_path())
 
 
 def save_state(state):
-    state_path = get_state_path()
-    mkdir_p(state_path)
-    for pkg in state:
-        state_str = json.dumps(state[pkg], indent=2)
-        pkgf = state_path / (pkg + '.json')
-        with pkgf.open('w') as f:
-            f.write(state_str)
-
-
-def parse_installed_packages(s):
-    pkgs = s.split('\n')
-    pkgs = filter(lambda s: s != '', pkgs)
-    pkgs = odict([p.split(' ') for p in pkgs])
-    return pkgs
-        
-
-def get_owned_files(installed_pkgs):
-    PACMAN_FILE_LIST_CMD = ['pacman', '-Ql'] + list(installed_pkgs.keys())
-    fs = check_output(PACMAN_FILE_LIST_CMD, universal_newlines=True).split('\n')
-    r = odict()
-    for line in fs:
-        if not line:
-            continue
-        l = line.split(' ', 1)
-        if len(l) != 2:
-            raise Exception(line)
-        pkg, f = l
-
-        assert(pkg in installed_pkgs)
-        ver = installed_pkgs[pkg]
-        r.setdefault(pkg, odict())
-        r[pkg].setdefault(ver, [])
-        r[pkg][ver].append(f)
-    return r
+    pstate.save_state(state, get_state_path())
 
 
 def find_pkg_owned_files(chroot_path, chroot_default_files):
     pkg_files = list_files(chroot_path)
-    pkg_files = filter(lambda p: p not in chroot_default_files, pkg_files)
+    pkg_files = filter(lambda p: str(p) not in chroot_default_files, pkg_files)
     pkg_files = list(pkg_files)
-    hashes = [file_hash(str(chroot_path / p)) for p in pkg_files]
+    hashes = [chroot_file_hash(chroot_path / p) for p in pkg_files]
 
     pkg_files = [Path('/') / p for p in pkg_files]
 
@@ -270,12 +202,25 @@ def prepare_pacman_db():
         shutil.rmtree(str(PACMAN_DB_PATH))
     mkdir_p(PACMAN_DB_PATH)
     #check_call('sudo pacman -Sy -b '.split() + [str(PACMAN_DB_PATH)])
-    (PACMAN_DB_PATH / 'sync').symlink_to('/var/lib/pacman/sync')
+
+
+_pacman_dbs = threading.local()
+
+def pacman_db_path():
+    '''a pacman db of the calling thread's own, concurrent installs would fail on each other's db.lck'''
+    p = getattr(_pacman_dbs, 'path', None)
+    if p is None:
+        mkdir_p(PACMAN_DB_PATH)
+        p = _pacman_dbs.path = Path(tempfile.mkdtemp(prefix='db-', dir=str(PACMAN_DB_PATH)))
+        (p / 'sync').symlink_to('/var/lib/pacman/sync')
+    return p
 
 #patch pacman call so that it doesn't sync db /every/ time
 def nosync_pacman():
-    nosync_pacman = Path(pacman_base)
-    cmd = "env PATH=%s /usr/bin/pacman ${@/'-Sy'/-S} --dbpath %s -dd --nodeps" % (os.getenv('PATH'), str(PACMAN_DB_PATH))
+    db_path = pacman_db_path()
+    nosync_pacman = db_path / 'bin' / 'pacman'
+    mkdir_p(nosync_pacman.parent)
+    cmd = "env PATH=%s /usr/bin/pacman ${@/'-Sy'/-S} --dbpath %s -dd --nodeps" % (os.getenv('PATH'), str(db_path))
     nosync_pacman.write_text('''#!/usr/bin/env sh
     echo "%s"
     %s
@@ -286,33 +231,67 @@ def nosync_pacman():
     return path
 
 
-#patch pacman call so that it doesn't sync db /every/ time
+_aur_client = None
+_build_cache = None
+
+def aur_client():
+    global _aur_client
+    if _aur_client is None:
+        # requests is slow to import, only load it when AUR packages are involved
+        from .aur import AurClient
+        _aur_client = AurClient(get_cache_path() / 'aur', base_url=args.aur_url, offline=args.offline)
+    return _aur_client
+
+
+def build_cache():
+    global _build_cache
+    if _build_cache is None:
+        from .aur import BuildCache
+        _build_cache = BuildCache(get_cache_path() / 'aur' / 'packages')
+    return _build_cache
+
+
+_state_client = None
+_state_lock = threading.Lock()
+_output_lock = threading.Lock()
+
+def state_client():
+    global _state_client
+    if _state_client is None and args.state_server:
+        from .stateserver import StateClient
+        _state_client = StateClient(args.state_server, get_cache_path() / 'state-server', arch, token=state_server_token())
+    return _state_client
+
+
+def fill_state(state, installed_pkgs):
+    '''add the state of installed package versions we haven't computed ourselves from the state server'''
+    client = state_client()
+    if client is None:
+        return
+    wanted = [(pkg, version) for pkg, version in installed_pkgs.items() if not (pkg in state and version in state[pkg])]
+    if not wanted:
+        return
+    fetched = client.fetch(wanted)
+    for (pkg, version), files in fetched.items():
+        state.setdefault(pkg, PkgState())
+        state[pkg][version] = files
+    save_state(odict((pkg, state[pkg]) for pkg, _ in fetched))
+    log.info('fetched the state of %s of %s package versions from %s' % (len(fetched), len(wanted), args.state_server))
+
+
+#patch pacman call so that it installs the (possibly cached) AUR build
 def aur_pacman(pkg, chroot, pkgbuild_path, version_path):
-    os.rmdir(pkgbuild_path)
+    from .aur import extract_snapshot
     os.rmdir(version_path)
 
-    aur_pkg_page = 'https://aur.archlinux.org/packages/%s/' % pkg
-    r = requests.get(aur_pkg_page)
-    if r.status_code != 200:
-        raise AurException('Package %s not found in AUR at %s. (Did you install this package from a disabled pacman repo?)' % (pkg, aur_pkg_page)) 
-    find_re = '<a href="([^"]+)">Download snapshot</a>'
-    m = re.search(find_re, r.text)
-    if not m:
-        log.debug(r.text)
-        raise AurException('no snapshot url found on %s' % aur_pkg_page)
-    snapshot_url = m.group(1)
-    snapshot_url_info = urllib.parse.urlsplit(snapshot_url)
-    url_path = Path(snapshot_url_info.path)
-    tar_file = url_path.name
-    # hack off any leftover ext
-    pkg_extract_dir = url_path.stem.split('.')[0]
-    if not snapshot_url_info.hostname:
-        snapshot_url = urllib.parse.urlunsplit(('https', 'aur.archlinux.org', snapshot_url_info.path, snapshot_url_info.query, snapshot_url_info.fragment))
-    log.info('Getting snapshot from %s', snapshot_url)
-
-    aur_pacman = Path(tempfile.mkdtemp(prefix='pacman')) / Path(pacman_base)
-
-    # sudo -u $USERNAME -H git clone https://aur.archlinux.org/${PKG}.git $TEMPD
+    client = aur_client()
+    info = client.pkg_info(pkg)
+    pkgbase = info['PackageBase']
+    extract_snapshot(client.snapshot(pkg), pkgbuild_path)
+    pkg_file = build_cache().build(Path(pkgbuild_path) / pkgbase, pkgbase, pkg, info['Version'], arch)
+    shutil.rmtree(pkgbuild_path)
+
+    aur_pacman = temp_dir('pacman') / 'pacman'
 
     cmd = r"""#!/usr/bin/env sh
     set -x
@@ -324,42 +303,15 @@ def aur_pacman(pkg, chroot, pkgbuild_path, version_path):
     sudo -u {USERNAME} -H $@
     }}
 
-    _sudo mkdir -p {TEMPD}
-    cd {TEMPD}
-    _sudo curl -q -L -O {SNAPSHOT}
-    _sudo tar -xvf {TAR_FILE}
-    _sudo rm {TAR_FILE}
-    cd {EXTRACT_DIR}
-    _sudo BUILDDIR=/tmp/makepkg-pacutil makepkg -sr --asdeps --noconfirm
-    /usr/bin/pacman -r {CHROOT} -U --noconfirm --dbpath {PACMANDB} -dd --nodeps {TEMPD}/{PKG}/{PKG}*.pkg.tar.xz
+    /usr/bin/pacman -r {CHROOT} -U --noconfirm --dbpath {PACMANDB} -dd --nodeps {PKG_FILE}
     _sudo /usr/bin/pacman -Q --dbpath {PACMANDB} {PKG} > {VERSION_PATH}
-    cd /
-    _sudo rm -rf {TEMPD}
-    """.format(PATH=os.getenv('PATH'), USERNAME=username, PACMANDB=str(PACMAN_DB_PATH), TEMPD=pkgbuild_path, PKG=pkg, CHROOT=chroot, VERSION_PATH=version_path, SNAPSHOT=snapshot_url, TAR_FILE=tar_file, EXTRACT_DIR=pkg_extract_dir)
+    """.format(PATH=os.getenv('PATH'), USERNAME=username, PACMANDB=str(pacman_db_path()), PKG=pkg, CHROOT=chroot, VERSION_PATH=version_path, PKG_FILE=str(pkg_file))
     log.debug(cmd)
     aur_pacman.write_text(cmd)
     chmod('+x', aur_pacman)
     aur_path = str(aur_pacman.parent.absolute()) + ':' + os.getenv('PATH')
     return aur_path
 
-def iter_states(state, pkgs):
-    for pkg, version in pkgs.items():
-        if pkg not in state or version not in state[pkg]:
-            continue
-        yield (pkg, version), state[pkg][version]
-
-def search_filepath_state(p, state, pkgs):
-    return [info for info, filenames in iter_states(state, pkgs) if p in filenames]
-    
-def search_filepath(p, pkgs):
-    for pkg, versions in pkgs.items():
-        assert(len(versions) == 1)
-        for version in sorted(versions.keys(), key=lambda s: '_' if s is None else s):
-            fs = versions[version]
-            if p in fs:
-                return (pkg, version)
-    return None
-    
 def get_orphan_pkgs():
     ls = []
     if ORPHAN_PKGS_FILE.exists():
@@ -383,31 +335,32 @@ def get_orphan_pkgs():
 
 
 def get_file_org(pkg, version, files, outdir, is_aur):
-    chroot_path = CHROOT_PATH / 'org' / pkg
-    if is_aur:
-        log.info('AUR package')
-        pkgbuild_path = temp_dir('aurbuild-%s' % pkg)
-        version_path = temp_dir('version-%s' % pkg)
-        _path = aur_pacman(pkg, str(chroot_path), str(pkgbuild_path), str(version_path))
-    else:
-        _path = nosync_pacman()
-
-    def job(_):
-        r = []
+    def job(chroot_path):
+        pairs = []
         for src in files:
             src = Path(src)
             assert(src.is_absolute())
             rel = src.relative_to('/')
+            make_accessible(chroot_path, rel)
             src = chroot_path / rel
             dst = outdir / rel
             mkdir_p(dst.parent)
 
             assert(src.exists())
-            check_output(['sudo', 'cp', '-a', str(src), str(dst)])
-            r.append(dst)
-        return r
+            pairs.append((src, dst))
+        copy_archive_batch(pairs, sudo=True)
+        return [dst for _, dst in pairs]
+
+    with chroot_pool().chroot() as chroot_path:
+        if is_aur:
+            log.info('AUR package')
+            pkgbuild_path = temp_dir('aurbuild-%s' % pkg)
+            version_path = temp_dir('version-%s' % pkg)
+            _path = aur_pacman(pkg, str(chroot_path), str(pkgbuild_path), str(version_path))
+        else:
+            _path = nosync_pacman()
 
-    ref_version, fs = install_pkg(chroot_path, pkg, job, str(_path))
+        ref_version, fs = install_pkg(chroot_path, pkg, job, str(_path))
     #if is_aur:
     #    aur_version = Path(version_path).read_text()
     #    aur_version = aur_version.split(' ', 1)[1].strip()
@@ -415,61 +368,22 @@ def get_file_org(pkg, version, files, outdir, is_aur):
     return fs
 
 
-def tag_escape(tag):
-    return tag.replace(':', '_')
-
-def tag_name(branch, version=None):
-    if version is None:
-        version = BASE_TAG_NAME
-    s = branch + TAG_SEP + version
-    return tag_escape(s)
-
-def tag_split(tag):
-    return tag.split(TAG_SEP, 1)
-
 def machine_branch(pkg):
     return pkg + MACHINE_SEP + machine
 
 def machine_branch_main():
     return MACHINE_SEP + machine
 
-class PkgRepo(_hg):
-    def __init__(self, *args):
-        _hg.__init__(self, *args, log=log)
-
-
-    def files_differ(self, fs, integrity_check=False):
-        #check if all files are present
-        differs = False
-        for f in fs:
-            fp = Path(f)
-            assert(fp.is_absolute())
-            p = repo_path / fp.relative_to('/')
-            if not p.exists() or (integrity_check and file_hash(str(p)) != file_hash(f)):
-                differs = True
-                log.info('%s differs from %s' % (p, f))
-
-        #check if files were removed
-        for p in self.repo_files():
-            p = Path(p)
-            if not p.is_file() or hg.is_repo_internal_dir(p):
-                continue
-            f = Path('/') / p.relative_to(repo_path)
-            if not f.exists():
-                differs = True
-                log.info('%s differs from %s' % (p, f))
-        return differs
-
-
-def get_installed_pkgs(native_only=False):
-    flags = '-Q'
-    if native_only:
-        flags += 'n'
-    return parse_installed_packages(check_output(['pacman', flags], universal_newlines=True))
 
+PACSTRAP_PKG = 'arch-install-scripts'
 
-def check_packages(args):
-    prepare_pacman_db()
+def get_chroot_default_files():
+    # files pacstrap creates by itself only depend on the pacstrap version
+    pacstrap_version = check_output(['pacman', '-Q', PACSTRAP_PKG], universal_newlines=True).split()[1]
+    baseline_path = get_cache_path() / 'chroot-baseline' / ('%s-%s.json' % (arch, tag_escape(pacstrap_version)))
+    if baseline_path.exists():
+        with baseline_path.open('r') as f:
+            return set(json.load(f))
 
     #get list of chroot pkg_owned_files
     noop_pacman = Path(pacman_base)
@@ -478,31 +392,52 @@ def check_packages(args):
     echo $@''')
     chmod('+x', noop_pacman)
     path = str(noop_pacman.parent.absolute()) + ':' + os.getenv('PATH')
-    chroot_default_version, chroot_default_files = install_pkg(CHROOT_PATH / 'DUMMY', 'DUMMY', list_files, path)
+    with chroot_pool().chroot() as chroot_path:
+        _, chroot_default_files = install_pkg(chroot_path, 'DUMMY', lambda p: sorted(map(str, list_files(p))), path)
+
+    mkdir_p(baseline_path.parent)
+    # spool workers may compute it concurrently
+    with atomic_open(baseline_path, 'w') as f:
+        json.dump(chroot_default_files, f, indent=2)
+    return set(chroot_default_files)
+
 
-    installed_pkgs = get_installed_pkgs()
-    installed_native_pkgs = get_installed_pkgs(native_only=True)
+def check_packages(args):
+    from .aur import AurException
+    prepare_pacman_db()
+
+    async def initial_queries():
+        loop = asyncio.get_running_loop()
+        chroot_default_files = loop.run_in_executor(None, get_chroot_default_files)
+        state = loop.run_in_executor(None, load_state)
+        installed_pkgs, installed_native_pkgs, backup_files, _ = await query_pacman(owned_files=False, local_db=local_db())
+        return installed_pkgs, installed_native_pkgs, backup_files, await state, await chroot_default_files
+
+    installed_pkgs, installed_native_pkgs, backup_files, state, chroot_default_files = asyncio.run(initial_queries())
     filter_odict(installed_pkgs, pkg_blacklist)
     filter_odict(installed_native_pkgs, pkg_blacklist)
+    pstate.record_installed(get_state_path(), machine, installed_pkgs)
+    fill_state(state, installed_pkgs)
 
     pkgs_version_not_found = []
 
-    state = load_state()
-    config_files = get_config_files()
+    # resolve all AUR packages in a few batched requests up front
+    if not args.native_only:
+        aur_client().info([pkg for pkg in installed_pkgs if pkg not in installed_native_pkgs])
+
     for i, (pkg, version) in enumerate(installed_pkgs.items()):
         def print_progress(msg):
             log.message('[%s/%s]: %s %s' % (i + 1, len(installed_pkgs), col.header(pkg), msg))
         requested_version = version
 
         def owned_check(version, pkg_files):
-            if pkg in config_files and version in config_files[pkg]:
-                for changed, f in config_files[pkg][version]:
+            if pkg in backup_files and version in backup_files[pkg]:
+                for f, _ in backup_files[pkg][version]:
                     if not (f in map(str, pkg_files)):
                         raise Exception('%s not in %s' % (f, pkg_files))
 
 
 
-        chroot_path = CHROOT_PATH / pkg
         is_aur = pkg not in installed_native_pkgs
         install_f = install_pkg
         if is_aur:
@@ -510,7 +445,7 @@ def check_packages(args):
                 continue
             install_f = install_pkg_aur
 
-        def find_files(_):
+        def find_files(chroot_path):
             return odict(find_pkg_owned_files(chroot_path, chroot_default_files))
 
         pkg_files = None
@@ -524,13 +459,13 @@ def check_packages(args):
                 except Exception as e:
                     log.info(e)
                     print_progress('found')
-                    version, pkg_files = install_f(chroot_path, pkg, find_files)
+                    version, pkg_files = install_pooled(install_f, pkg, find_files)
             else:
                 msg = 'not checked yet'
                 if pkg in state:
                     msg = 'version %s not checked yet, only %s' % (version, ', '.join(state[pkg].keys()))
                 print_progress(msg)
-                version, pkg_files = install_f(chroot_path, pkg, find_files)
+                version, pkg_files = install_pooled(install_f, pkg, find_files)
                 owned_check(version, pkg_files)
         except PacmanException as e:
             log.error('skipping %s: %s' % (pkg, str(e)))
@@ -542,113 +477,293 @@ def check_packages(args):
         if pkg_files:
             #print('\n'.join(list(map(str, (pkg_files)))))
 
-            state.setdefault(pkg, odict())
-            state[pkg][version] = pkg_files
-            save_state({pkg: state[pkg]})
+            # spool workers may write to the same state
+            state[pkg] = pstate.update_pkg_state(get_state_path(), pkg, version, pkg_files)
+            if state_client():
+                state_client().upload(pkg, version, pkg_files)
 
         if version != requested_version:
             pkgs_version_not_found.append(pkg)
 
 
-def main(args):
-    checked_paths = [Path(a) for a in args.paths]
-    
-    installed_pkgs = get_installed_pkgs()
-    installed_native_pkgs = get_installed_pkgs(native_only=True)
+def iter_root_files(root, checked_paths):
+    # paths as seen from inside root
+    for p in iter_files([Path(root) / p.relative_to('/') for p in checked_paths]):
+        yield Path('/') / p.relative_to(root)
 
-    state = load_state()
 
-    # a dict of pkg -> list of (modified_state, filepath)
-    config_files = get_config_files()
-    
-    modified_config_files = odict()
-    unmodified_config_files = odict()
-    for pkg, vs in config_files.items():
-        modified_config_files[pkg] = odict()
-        unmodified_config_files[pkg] = odict()
-        for version, fs in vs.items():
-            modified_config_files[pkg][version] = [f for f in fs if f[0] == MODIFIED]
-            unmodified_config_files[pkg][version] = [f for f in fs if f[0] == UNMODIFIED]
-
-    owned_files = get_owned_files(installed_pkgs)
-
-    orphan_files = []
-    modified_files = odict()
-    uncheckable_files = []
-    files = []
-    for d in checked_paths:
-        if Path(d).is_file():
-            files += [Path(d)]
+def collect_root_files(root, checked_paths):
+    return list(iter_root_files(root, checked_paths))
+
+
+def spool_enqueue(args):
+    async def queries():
+        state = asyncio.get_running_loop().run_in_executor(None, load_state)
+        installed_pkgs, installed_native_pkgs, backup_files, _ = await query_pacman(owned_files=False, local_db=local_db())
+        return installed_pkgs, installed_native_pkgs, backup_files, await state
+
+    installed_pkgs, installed_native_pkgs, backup_files, state = asyncio.run(queries())
+    filter_odict(installed_pkgs, pkg_blacklist)
+    fill_state(state, installed_pkgs)
+    spool = Spool(args.spool)
+    queued = 0
+    for pkg, version in installed_pkgs.items():
+        is_aur = pkg not in installed_native_pkgs
+        if (pkg in state and version in state[pkg]) or (is_aur and args.native_only):
+            continue
+        # workers on other hosts may not have the package installed, so the config files to expect travel with the job
+        pkg_config_files = [f for f, _ in backup_files.get(pkg, {}).get(version, [])]
+        queued += spool.enqueue(pkg, version, dict(arch=arch, aur=is_aur, config_files=pkg_config_files))
+    log.message('queued %s packages, %s' % (queued, spool.counts()))
+
+
+def spool_work(args):
+    prepare_pacman_db()
+    chroot_default_files = get_chroot_default_files()
+
+    def find_files(chroot_path):
+        return odict(find_pkg_owned_files(chroot_path, chroot_default_files))
+
+    def run_job(job):
+        if job['arch'] != arch:
+            raise PacmanException('job is for %s, this worker checks %s' % (job['arch'], arch))
+        pkg = job['pkg']
+        version, pkg_files = install_pooled(install_pkg_aur if job['aur'] else install_pkg, pkg, find_files)
+        missing = [f for f in job['config_files'] if f not in pkg_files]
+        if missing and version == job['version']:
+            raise PacmanException('config files not in %s: %s' % (pkg, ' '.join(missing)))
+        pstate.update_pkg_state(get_state_path(), pkg, version, pkg_files)
+        if state_client():
+            state_client().upload(pkg, version, pkg_files)
+        # the repos may have moved on to a newer version than the one queued
+        return dict(version=version, files=len(pkg_files))
+
+    done, failed = spool_run(Spool(args.spool, args.stale_after), run_job, args.wait)
+    log.message('%s done, %s failed' % (done, failed))
+
+
+def spool_status(args):
+    log.message(' '.join('%s: %s' % kv for kv in Spool(args.spool).counts().items()))
+
+
+async def load_index(hash_cache=None, checked_paths=None, root=None, state=None, references=None):
+    '''the index and the files below checked_paths, pacman queries, state loading and the walk all run concurrently
+
+    With root, the system installed below root is checked and checked_paths are paths inside it.'''
+    loop = asyncio.get_running_loop()
+    loading_state = loop.run_in_executor(None, load_state) if state is None else None
+    files = None
+    if checked_paths is not None:
+        if root is None:
+            files = loop.run_in_executor(None, collect_files, checked_paths)
         else:
-            files += clean_glob(d)
-    log.info('hashing %s files...' % len(files), )
+            files = loop.run_in_executor(None, collect_root_files, root, checked_paths)
 
+    # backup_files: pkg -> {version: [(path, md5)]}, verified by the index through hash_cache when classifying
+    installed_pkgs, installed_native_pkgs, backup_files, owned_files = await query_pacman(local_db=local_db(root), root=root)
+    if root is None:
+        pstate.record_installed(get_state_path(), machine, installed_pkgs)
+    if loading_state is not None:
+        state = await loading_state
+    with _state_lock:
+        await loop.run_in_executor(None, fill_state, state, installed_pkgs)
+    index = FileIndex(installed_pkgs, installed_native_pkgs, state, backup_files, owned_files, ignored_paths, hash_cache, root, references)
+    if files is not None:
+        files = await files
+    return index, files
 
-    start_time = time.perf_counter()
-    last_time = start_time
-    for ifile, p in enumerate(files):
 
-        now = time.perf_counter()
-        if now - last_time > progress_every:
-            last_time = now
-            log.debug('%s%%' % int(ifile / len(files) * 100), )
+def build_index(hash_cache=None):
+    index, _ = asyncio.run(load_index(hash_cache))
+    return index
 
-        presolved = p.resolve()
 
-        # don't filter earlier as resolve is expensive
-        if startswith_any(str(p), ignored_paths) or startswith_any(str(presolved), ignored_paths):
-            continue
+def scan_daemon(checked_paths):
+    r = daemon_request(args.socket, dict(cmd='check-files', paths=[str(p.absolute()) for p in checked_paths]))
+    modified_files = odict(r['modified'])
+    uncheckable_files = [(s, tuple(pkg_version)) for s, pkg_version in r['uncheckable']]
+    return modified_files, r['orphans'], uncheckable_files, odict(r['pkgs'])
 
-        p = presolved
-        if not p.is_file():
-            continue
-        s = str(p)
 
-        pkg = None
-        version = None
-        r = search_filepath_state(s, state, installed_pkgs)
-        if r:
-            # pacman knows the file and we've seen it before in this
+def report_classified(c):
+    owner = ' %s %s' % (c.pkg, c.version) if c.pkg else ''
+    log.message('%s: %s%s' % (c.cls, c.path, owner))
 
-            # assume pacman ensures that no two packages may own the same file
-            r = r[0]
 
-            pkg, version = r
-            phash = state[pkg][version][s]
-            try:
-                hash = file_hash(p)
-            except PermissionError:
-                cmd = ['sudo', 'sha256sum', str(p)]
-                log.message(' '.join(cmd))
-                hash = check_output(cmd)
+def file_record(c):
+    return {'path': c.path, 'class': c.cls, 'pkg': c.pkg, 'version': c.version, 'expected': c.expected, 'actual': c.actual}
 
-            if hash == phash:
-                continue
-        else:
-            # pacman knows this as a config file
-            r = search_filepath(s, config_files)
-            if r:
-                pkg, version = r
-                if search_filepath(s, unmodified_config_files):
-                    assert(search_filepath(s, modified_config_files))
-                    continue
-
-            r = search_filepath(s, owned_files)
-            if r:
-                pkg, version = r
-                uncheckable_files.append((s, r))
-                continue
-            orphan_files.append(s)
-            continue
 
-        modified_files.setdefault(pkg, [])
-        modified_files[pkg].append(s)
+def write_record(out, record):
+    # whole lines only, roots may be checked concurrently
+    with _output_lock:
+        out.write(json.dumps(record) + '\n')
+        out.flush()
 
-    modified_files = odict(sorted([fs for fs in modified_files.items()], key=lambda fs: fs[0]))
 
+def stream_files(index, files, jobs, start_time, out=sys.stdout):
+    '''write one json record per file as soon as it is classified and a summary record at the end, nothing is committed
 
+    Records of a root checked with --root carry the root, orphans there are never associated with a package.'''
+    orphan_pkg_associations = get_orphan_pkgs() if index.root is None else {}
+    extra = {} if index.root is None else dict(root=index.root)
+    counts = odict()
+    for c in classify_files(index, files, jobs):
+        counts[c.cls] = counts.get(c.cls, 0) + 1
+        record = file_record(c)
+        if c.cls == ORPHAN_FILE:
+            record['orphan_pkg'] = orphan_pkg_associations.get(c.path)
+        record.update(extra)
+        write_record(out, record)
+    summary = dict(files=sum(counts.values()), counts=counts, seconds=round(time.perf_counter() - start_time, 3), **extra)
+    write_record(out, dict(summary=summary))
+
+
+def report_root(root, modified_files, orphan_files, uncheckable_files):
+    lines = [col.header(root)]
+    for pkg, fs in modified_files.items():
+        lines.append('modified %s: %s' % (pkg, ' '.join(fs)))
+    lines += ['orphan: %s' % f for f in orphan_files]
+    lines.append('%s modified, %s orphan, %s uncheckable files' % (sum(map(len, modified_files.values())), len(orphan_files), len(uncheckable_files)))
+    with _output_lock:
+        log.message('\n'.join(lines))
 
 
+def check_roots(args, roots, checked_paths):
+    '''check the systems installed below roots concurrently, only reporting, nothing is committed
+
+    The state is loaded once and roots share the path lists of the package versions they have in common.'''
+    start_time = time.perf_counter()
+    state = load_state()
+    references = ReferenceCache()
+
+    def check_root(root):
+        index, files = load_checked_files(args, checked_paths, root, state, references, stream=args.format == 'jsonl')
+        if args.format == 'jsonl':
+            return stream_files(index, files, args.jobs, start_time)
+        modified_files, orphan_files, uncheckable_files = scan_files(index, files, progress_every, args.jobs)
+        report_root(root, modified_files, orphan_files, uncheckable_files)
+
+    failed = []
+    # every root hashes with its own pool of args.jobs threads
+    with ThreadPoolExecutor(min(args.root_jobs, len(roots)), initializer=governor.init_worker) as executor:
+        futures = [(root, executor.submit(check_root, root)) for root in roots]
+        for root, f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                log.error('checking %s failed: %s' % (root, e))
+                failed.append(root)
+    if failed:
+        exit(1)
+
+
+def watch_files(checked_paths, rescan_interval):
+    index = build_index()
+    index_generation = local_db_generation()
+
+    # only report changes in classification
+    reported = {}
+    def classify(p):
+        c = index.classify(p)
+        last = reported.get(c.path)
+        if c.cls in (MODIFIED_FILE, ORPHAN_FILE):
+            if last != c.cls:
+                report_classified(c)
+            reported[c.path] = c.cls
+        elif last is not None:
+            report_classified(c)
+            del reported[c.path]
+
+    watcher = Watcher(checked_paths, rescan_interval)
+    try:
+        for p in collect_files(checked_paths):
+            classify(p)
+        log.info('watching %s directories' % len(watcher.dirs))
+        for dirty in watcher.batches():
+            generation = local_db_generation()
+            if generation != index_generation:
+                log.info('packages changed, reloading index')
+                index = build_index(index.hash_cache)
+                index_generation = generation
+            for p in sorted(dirty):
+                classify(p)
+    finally:
+        watcher.close()
+
+
+def batch_comparer(index):
+    try:
+        from .columnar import ColumnarState, BatchComparer
+    except ImportError as e:
+        log.warning('cannot compare in batches, comparing file by file: %s' % e)
+        return None
+    return BatchComparer(ColumnarState.from_index(index))
+
+
+def load_checked_files(args, checked_paths, root=None, state=None, references=None, stream=False):
+    '''the index and the files to check, either below checked_paths or owned by the requested packages
+
+    With stream and the walk order, files are handed out while the walk goes on instead of collected up front.'''
+    by_package = args.package or args.all_packages
+    walk_later = stream and not by_package and args.io_order == 'walk'
+    # checking packages skips the walk, their file lists come with the index
+    index, files = asyncio.run(load_index(HashCache(args.drop_cache), None if by_package or walk_later else checked_paths, root, state, references))
+    if walk_later:
+        return index, iter_files(checked_paths) if root is None else iter_root_files(root, checked_paths)
+    if by_package:
+        # raises IndexException for packages that are not installed
+        files = package_files(index, None if args.all_packages else args.package)
+    return index, Ordered(files, args.io_order, root)
+
+
+def main(args):
+    checked_paths = [Path(a) for a in args.paths]
+    by_package = args.package or args.all_packages
+    if by_package and (checked_paths or args.watch):
+        log.error('--package and --all-packages check the files of packages, they take no paths and cannot be watched')
+        exit(1)
+    if not checked_paths and not by_package and not args.root:
+        log.error('nothing to check, give paths or --package')
+        exit(1)
+
+    if args.root:
+        if args.watch or args.daemon or args.batch:
+            log.warning('--watch, --daemon and --batch are ignored with --root')
+        if args.format == 'jsonl':
+            log.messages_to_stderr()
+        return check_roots(args, [str(Path(r).absolute()) for r in args.root], checked_paths or [Path('/')])
+
+    if args.watch:
+        return watch_files(checked_paths, args.rescan_interval)
+    if args.format == 'jsonl':
+        if args.daemon or args.batch:
+            log.warning('--daemon and --batch are ignored with --format jsonl')
+        log.messages_to_stderr()
+        start_time = time.perf_counter()
+        try:
+            index, files = load_checked_files(args, checked_paths, stream=True)
+        except IndexException as e:
+            log.error(e)
+            exit(1)
+        return stream_files(index, files, args.jobs, start_time)
+
+    r = None
+    if args.daemon and not by_package:
+        try:
+            r = scan_daemon(checked_paths)
+        except (OSError, DaemonException) as e:
+            log.warning('cannot use daemon, checking locally: %s' % e)
+    if r is None:
+        try:
+            index, files = load_checked_files(args, checked_paths)
+        except IndexException as e:
+            log.error(e)
+            exit(1)
+        log.info('hashing %s files...' % len(files), )
+        comparer = batch_comparer(index) if args.batch else None
+        r = scan_files(index, files, progress_every, args.jobs, comparer) + (index.pkg_info(),)
+    modified_files, orphan_files, uncheckable_files, pkg_info = r
 
     orphan_pkg_associations = get_orphan_pkgs()
 
@@ -666,7 +781,7 @@ def main(args):
     #print
     for pkg, fs in modified_files.items():
         log.info(pkg)
-        log.info(installed_pkgs[pkg])
+        log.info(pkg_info[pkg]['version'])
         log.info('\t%s' % (' '.join(fs)))
 
     repo = PkgRepo(str(repo_path))
@@ -710,14 +825,28 @@ def main(args):
     pkgs = pkgs_unique
 
     # drop pkgs that don't have state
-    pkgs = [pkg for pkg in pkgs if pkg in state and installed_pkgs[pkg] in state[pkg]]
+    pkgs = [pkg for pkg in pkgs if pkg in pkg_info and pkg_info[pkg]['has_state']]
     
-    machine_branches = []
-    for pkg in pkgs:
+    def report():
+        def print_paths(l):
+            log.message('\n'.join(map(str, l)))
+
+        #print('### modified')
+        #print_paths(modified_files)
+
+
+        log.message('''### These files are not associated with any package:
+    Add "<pkg> <filepath>" to %s to assign them to a package.''' % ORPHAN_PKGS_FILE)
+        print_paths(ignored_orphan_files)
+        log.message('### uncheckable')
+        print_paths(uncheckable_files)
+
+    def stage(repo, pkg):
+        wc_path = Path(repo.repo_path)
         # blacklisted or version not found
-        if pkg not in installed_pkgs:
-            continue
-        version = installed_pkgs[pkg]
+        if pkg not in pkg_info:
+            return
+        version = pkg_info[pkg]['version']
         log.message(col.header('%s %s' % (pkg, version)))
 
         #can only update last version
@@ -727,7 +856,7 @@ def main(args):
             log.error('history rewriting (i.e. downgrading) not supported: %s %s < %s' % (pkg, tag_version, pkg_committed_versions[pkg][-1]))
             log.debug(versions)
             log.debug(natural_comp(tag_version), *[natural_comp(v) for v in pkg_committed_versions[pkg]])
-            continue
+            return
 
         #create pkg branch from master branch
         repo.ensure_branch(pkg, from_branch=DEFAULT_BRANCH, commit=False, clean=True)
@@ -739,12 +868,13 @@ def main(args):
             assert(not str(s) in orphan_files)
         log.info('with files: %s' % ' '.join(fs))
 
-        if repo.files_differ(fs):
-            fs = get_file_org(pkg, version, fs, repo_path, is_aur=pkg not in installed_native_pkgs)
+        # a new pkg branch starts out with the files of the default branch
+        if repo.files_differ(fs, manifests.get(pkg, manifests.get(DEFAULT_BRANCH, set()))):
+            fs = get_file_org(pkg, version, fs, wc_path, is_aur=not pkg_info[pkg]['native'])
             fs = list(map(str, fs))
             msg = tag_name(pkg, version)
             repo.commit_and_tag(fs, msg, tag)
-            
+
         def repo_machine_branch(version, fs):
             #machine branches
             branch = machine_branch(pkg)
@@ -763,13 +893,14 @@ def main(args):
             if has_pkg_branch:
                 repo.commit_merge(pkg)
 
-            gfs = []
+            pairs = []
             for s in fs:
                 src = Path(s)
-                dst = repo_path / src.relative_to('/')
+                dst = wc_path / src.relative_to('/')
                 mkdir_p(dst.parent)
-                check_output(['sudo', 'cp', '-a', str(src), str(dst)])
-                gfs.append(str(dst))
+                pairs.append((src, dst))
+            copy_archive_batch(pairs, sudo=True)
+            gfs = [str(dst) for _, dst in pairs]
 
 
             tag = tag_name(branch, version)
@@ -782,19 +913,38 @@ def main(args):
         fs += orphan_files.get(pkg, [])
         repo_machine_branch(version, fs)
 
-    def print_paths(l):
-        log.message('\n'.join(map(str, l)))
+    # read once, staging a package only commits to its own branches
+    manifests = repo.branch_manifests()
 
-    #print('### modified')
-    #print_paths(modified_files)
+    jobs = min(args.jobs, len(pkgs))
+    if jobs <= 1:
+        for pkg in pkgs:
+            stage(repo, pkg)
+        return report()
 
+    # every worker has its own working copy, commits land in the shared store
+    workers = queue.Queue()
+    shares = list(share_working_copies(repo, jobs))
+    for share in shares:
+        workers.put(share)
 
-    log.message('''### These files are not associated with any package:
-    Add "<pkg> <filepath>" to %s to assign them to a package.''' % ORPHAN_PKGS_FILE)
-    print_paths(ignored_orphan_files)
-    log.message('### uncheckable')
-    print_paths(uncheckable_files)
+    def stage_in_share(pkg):
+        share = workers.get()
+        try:
+            stage(share, pkg)
+        finally:
+            workers.put(share)
+
+    with ThreadPoolExecutor(jobs, initializer=governor.init_worker) as executor:
+        futures = [executor.submit(stage_in_share, pkg) for pkg in pkgs]
+    errors = [f.exception() for f in futures if f.exception() is not None]
 
+    collect_share_tags(repo, shares)
+    if errors:
+        for e in errors:
+            log.error(e)
+        raise errors[0]
+    report()
 
 
 def merge_features(args):
@@ -833,6 +983,56 @@ def merge_machine_branches(args):
             #machine_repo.update(machine_branch_main(), clean=True)
             machine_repo.commit_merge(branch)
 
+def sync_plan(files):
+    # (repo file, live file, backup file or None) for every file that needs to be replaced
+    plan = []
+    unreadable = []
+    unsearchable = []
+    for f in files:
+        repo_file = machine_repo_path / f
+        fs_file = Path('/') / f
+        backup_file = backup_repo_path / f
+
+        try:
+            os.lstat(str(fs_file))
+        except (FileNotFoundError, NotADirectoryError):
+            plan.append((repo_file, fs_file, None))
+            continue
+        except PermissionError:
+            # lexists would call a file below a directory we can't search missing, and it would be replaced without backup
+            unsearchable.append((repo_file, fs_file, backup_file))
+            continue
+        if repo_file.is_symlink() or fs_file.is_symlink():
+            if not (repo_file.is_symlink() and fs_file.is_symlink() and os.readlink(str(repo_file)) == os.readlink(str(fs_file))):
+                plan.append((repo_file, fs_file, backup_file))
+            continue
+        if repo_file.stat().st_size != fs_file.stat().st_size:
+            plan.append((repo_file, fs_file, backup_file))
+            continue
+        try:
+            if file_hash(str(repo_file)) != file_hash(str(fs_file)):
+                plan.append((repo_file, fs_file, backup_file))
+        except PermissionError:
+            unreadable.append((repo_file, fs_file, backup_file))
+
+    types = file_types_sudo([fs_file for _, fs_file, _ in unsearchable])
+    for repo_file, fs_file, backup_file in unsearchable:
+        t = types.get(str(fs_file))
+        if t is None:
+            plan.append((repo_file, fs_file, None))
+        elif t == 'l' or repo_file.is_symlink():
+            # link targets aren't compared with privileges, the link is replaced
+            plan.append((repo_file, fs_file, backup_file))
+        else:
+            unreadable.append((repo_file, fs_file, backup_file))
+
+    hashes = file_hashes_sudo([fs_file for _, fs_file, _ in unreadable])
+    for repo_file, fs_file, backup_file in unreadable:
+        if file_hash(str(repo_file)) != hashes[str(fs_file)]:
+            plan.append((repo_file, fs_file, backup_file))
+    return plan
+
+
 def sync(args):
     machine_repo = hg(str(machine_repo_path))
     machine_repo.initialize()
@@ -843,30 +1043,150 @@ def sync(args):
     #git ls-tree -r "!$(hostname)" --name-only --full-name
     files = machine_repo.status(all=True, **{'no-status': True})
 
-    for f in files:
-        repo_file = machine_repo_path / f
-        fs_file = Path('/') / f
-        backup_file = backup_repo_path / f
+    plan = sync_plan(files)
+    if not plan:
+        log.message('Nothing changed.')
+        return
+
+    for repo_file, fs_file, backup_file in plan:
+        if backup_file:
+            log.message('backup %s -> %s' % (fs_file, backup_file))
+        log.message('install %s -> %s' % (repo_file, fs_file))
+    if args.dry_run:
+        return
+
+    backups = [(fs_file, backup_file) for _, fs_file, backup_file in plan if backup_file]
+    for _, backup_file in backups:
+        mkdir_p(backup_file.parent)
+    # backups have to be complete before their files are replaced
+    copy_archive_batch(backups, sudo=True)
+    copy_archive_batch([(repo_file, fs_file) for repo_file, fs_file, _ in plan], sudo=True)
 
-        log.debug(repo_file, fs_file, backup_file)
+    backup_files = [str(backup_file) for _, backup_file in backups]
+    if backup_files:
+        backup_repo.add(*backup_files)
+        if backup_repo.status(*backup_files, modified=True, added=True):
+            backup_repo.commit(*backup_files, message='synced')
 
-        if fs_file.exists():
-            mkdir_p(backup_file.parent)
-            copy_archive(fs_file, backup_file, sudo=True)
 
-        copy_archive(repo_file, fs_file, sudo=True)
-    backup_repo.add(*files)
-    if backup_repo.diff():
-        backup_repo.commit(message='synced')
+def daemon(args):
+    watched_paths = [PACMAN_LOCAL_DB, get_state_path(), IGNORE_FILE, ORPHAN_PKGS_FILE]
+    Daemon(build_index, watched_paths, args.socket).run()
+
+
+def get_path_index():
+    state_path = get_state_path()
+    state_generation = state_path.stat().st_mtime_ns if state_path.exists() else None
+    generation = '%s:%s' % (local_db_generation(), state_generation)
+    path_index = PathIndex(get_cache_path() / ('pathindex-%s.sqlite' % arch))
+    if path_index.generation != generation:
+        log.info('rebuilding path index')
+        path_index.rebuild(build_index(), generation)
+    return path_index
+
+
+def config_parity(args):
+    '''compare the backup file verification with what pacman -Qii reports'''
+    if args.recorded:
+        pacman_config_files = parse(ConfigFilesParser(), args.recorded.read_text()).result()
     else:
-        log.message('Nothing changed.')
-        
+        pacman_config_files = get_config_files()
+    # like pacman run without privileges, files we can't read are left out
+    ours = local_db().load().config_files(hash_cache=HashCache(sudo=False))
+    flatten = lambda cfs: set((pkg, version, changed, f) for pkg, versions in cfs.items()
+                              for version, fs in versions.items() for changed, f in fs)
+    expected, actual = flatten(pacman_config_files), flatten(ours)
+    status = {MODIFIED: 'MODIFIED', UNMODIFIED: 'UNMODIFIED'}
+    for pkg, version, changed, f in sorted(expected - actual):
+        log.message('pacman only: %s %s %s %s' % (pkg, version, status[changed], f))
+    for pkg, version, changed, f in sorted(actual - expected):
+        log.message('pacutil only: %s %s %s %s' % (pkg, version, status[changed], f))
+    log.message('%s backup files, %s differences' % (len(expected | actual), len(expected ^ actual)))
+    if expected != actual:
+        exit(1)
+
+
+def owner(args):
+    path_index = get_path_index()
+    for p in args.paths:
+        s = os.path.realpath(p)
+        r = path_index.lookup(s) or path_index.lookup(s + '/')
+        if r:
+            pkg, version, _, _ = r
+            log.message('%s is owned by %s %s' % (s, pkg, version))
+        else:
+            log.message('No package owns %s' % s)
+
+
+def verify(args):
+    paths = [str(Path(p).absolute()) for p in args.paths]
+    results = None
+    if args.daemon:
+        try:
+            results = daemon_request(args.socket, dict(cmd='verify', paths=paths))['results']
+        except (OSError, DaemonException) as e:
+            log.warning('cannot use daemon, checking locally: %s' % e)
+    if results is None:
+        path_index = get_path_index()
+        hash_cache = HashCache()
+        results = [path_index.classify(p, ignored_paths, hash_cache.digests)._asdict() for p in paths]
+    for c in results:
+        owner = ' %s %s' % (c['pkg'], c['version']) if c['pkg'] else ''
+        log.message('%s: %s%s' % (c['path'], c['cls'], owner))
+
+
+def state_compact(args):
+    state = load_state()
+    pstate.compact_state(state)
+    save_state(state)
+    log.message('compacted state of %s packages' % len(state))
+
+
+def state_gc(args):
+    state_path = get_state_path()
+    pstate.record_installed(state_path, machine, get_installed_pkgs())
+    state = load_state()
+    dropped = pstate.gc_state(state, pstate.installed_versions(state_path))
+    for pkg, version in dropped:
+        log.info('dropping %s %s' % (pkg, version))
+    if args.dry_run:
+        log.message('would drop %s package versions' % len(dropped))
+        return
+    pstate.compact_state(state)
+    save_state(state)
+    log.message('dropped %s package versions' % len(dropped))
+
+def state_server_token():
+    from .stateserver import TOKEN_ENV
+    return os.getenv(TOKEN_ENV) or getattr(config, 'state_server_token', None)
+
+
+def state_serve(args):
+    from .stateserver import serve, StateServerException
+    try:
+        serve(args.dir, args.bind, args.port, state_server_token())
+    except StateServerException as e:
+        log.error(e)
+        exit(1)
+
 p = argparse.ArgumentParser(description='check archlinux files for changes')
 p.add_argument('--verbose', '-v', action='store_true', help='enable verbose info output')
 p.add_argument('--debug', action='store_true', help='enable debug output')
 p.add_argument('--quiet', '-q', action='store_true', help='disable informative output')
 
 p.add_argument('--arch', default=None, help='override detected architecture')
+p.add_argument('--aur-url', default=getattr(config, 'aur_url', None), help='AUR base url')
+p.add_argument('--state-server', default=getattr(config, 'state_server', None), help='url of a pacutil state-serve instance to share package state with')
+p.add_argument('--offline', action='store_true', help='use cached AUR package info and snapshots only')
+p.add_argument('--socket', default=str(default_socket_path()), help='unix socket of the pacutil daemon')
+
+throttlep = p.add_argument_group('throttling', 'keep hashing from getting in the way of other workloads, for check-files, check-packages and spool work')
+throttlep.add_argument('--max-read-rate', type=parse_size, metavar='BYTES', help='read at most this many bytes per second when hashing, e.g. 50M')
+throttlep.add_argument('--max-iops', type=float, metavar='N', help='issue at most this many reads per second when hashing')
+throttlep.add_argument('--max-load', type=float, metavar='LOAD', help='pause while the 1 minute load average per cpu is above this')
+throttlep.add_argument('--max-io-pressure', type=float, metavar='PERCENT', help='pause while some tasks were stalled on io for more than this share of the last 10 seconds (/proc/pressure/io)')
+throttlep.add_argument('--idle-io', action='store_true', help='hash with idle io priority, so only otherwise unused disk time is used')
+throttlep.add_argument('--nice', type=int, metavar='N', help='raise the niceness of hashing threads and started commands by N')
 
 subp = p.add_subparsers()
 
@@ -875,7 +1195,19 @@ check_packages_p.add_argument('--native-only', action='store_true')
 check_packages_p.set_defaults(func=check_packages)
 
 checkp = subp.add_parser('check-files')
-checkp.add_argument('paths', nargs='+')
+checkp.add_argument('paths', nargs='*')
+checkp.add_argument('--root', '-r', action='append', metavar='DIR', help='check the system installed below DIR, e.g. an image or a container rootfs, using its own pacman db; may be repeated to check several roots concurrently, paths are then paths inside the roots and default to /')
+checkp.add_argument('--package', '-p', nargs='+', metavar='PKG', help='check only the files pacman says these packages own, skipping the walk and orphans')
+checkp.add_argument('--all-packages', action='store_true', help='check the files of all installed packages, skipping the walk and orphans')
+checkp.add_argument('--daemon', '-d', action='store_true', help='ask a running pacutil daemon instead of loading everything')
+checkp.add_argument('--watch', '-w', action='store_true', help='keep watching the paths and report modified and orphan files as they change, nothing is committed')
+checkp.add_argument('--rescan-interval', type=float, default=RESCAN_INTERVAL, help='seconds between rescans of directories that could not be watched')
+checkp.add_argument('--io-order', choices=IO_ORDERS, default='walk', help='hash files in walk order, or in batches sorted by inode or by physical extent (FIEMAP), which saves seeks on spinning disks')
+checkp.add_argument('--drop-cache', action='store_true', help="evict what hashing read into the page cache, files that were cached before are left alone")
+checkp.add_argument('--format', choices=['text', 'jsonl'], default='text', help='jsonl streams one record per checked file and a final summary to stdout instead of committing')
+checkp.add_argument('--jobs', '-j', type=int, default=1, help='hash files with this many threads and stage this many packages in parallel, each in its own working copy sharing the repo\'s store')
+checkp.add_argument('--root-jobs', type=int, default=2, help='check this many --root systems at a time, each hashing with --jobs threads')
+checkp.add_argument('--batch', action='store_true', help='compare digests against the state in vectorised batches, needs numpy')
 checkp.set_defaults(func=main)
 
 merge_machine_branchesp = subp.add_parser('merge-features', description='''Merge feature branches $pkg>$feature-name into the corrensponding $pkg-$host branch for this machine.''')
@@ -886,12 +1218,60 @@ merge_machine_branchesp = subp.add_parser('merge', description='''For every pack
 merge_machine_branchesp.set_defaults(func=merge_machine_branches)
 
 syncp = subp.add_parser('sync')
+syncp.add_argument('--dry-run', '-n', action='store_true', help='only show which files would be backed up and replaced')
 syncp.set_defaults(func=sync)
 
+daemonp = subp.add_parser('daemon', description='''Keep the file index in memory and answer check-files and verify requests over a unix socket.''')
+daemonp.set_defaults(func=daemon)
+
+ownerp = subp.add_parser('owner', description='''Show which package owns the given files.''')
+ownerp.add_argument('paths', nargs='+')
+ownerp.set_defaults(func=owner)
+
+verifyp = subp.add_parser('verify', description='''Show whether the given files are modified.''')
+verifyp.add_argument('paths', nargs='+')
+verifyp.add_argument('--daemon', '-d', action='store_true', help='ask a running pacutil daemon instead of loading everything')
+verifyp.set_defaults(func=verify)
+
+statep = subp.add_parser('state', description='''Maintain the stored package state.''')
+state_subp = statep.add_subparsers()
+state_compactp = state_subp.add_parser('compact', description='''Convert the stored state to the compact format and drop unused paths.''')
+state_compactp.set_defaults(func=state_compact)
+state_gcp = state_subp.add_parser('gc', description='''Drop package versions that are not installed on any machine that has recorded its installed packages.''')
+state_gcp.add_argument('--dry-run', '-n', action='store_true', help='only show what would be dropped')
+state_gcp.set_defaults(func=state_gc)
+
+state_servep = subp.add_parser('state-serve', description='''Serve package state over HTTP, so every package version only has to be checked once by one host of the fleet.
+Served state decides which files count as unmodified on every host using it, so anyone who can upload has to be trusted like root.
+Beyond localhost a shared token is required, from $PACUTIL_STATE_TOKEN or state_server_token in config.py, which clients send along.''')
+state_servep.add_argument('--bind', default='127.0.0.1', help='address to listen on, anything but loopback needs a token')
+state_servep.add_argument('--port', type=int, default=8731)
+state_servep.add_argument('--dir', type=Path, default=BASE_DIR / 'state-server', help='where the served state is stored')
+state_servep.set_defaults(func=state_serve)
+
+config_parityp = subp.add_parser('config-parity', description='''Check that pacutil's own verification of backup files agrees with pacman -Qii.''')
+config_parityp.add_argument('--recorded', type=Path, help='compare with this saved pacman -Qii output instead of running pacman')
+config_parityp.set_defaults(func=config_parity)
+
+spoolp = subp.add_parser('spool', description='''Check packages with many workers on one or more hosts, coordinated through a shared spool directory.''')
+spool_subp = spoolp.add_subparsers()
+spool_enqueuep = spool_subp.add_parser('enqueue', description='''Queue the installed package versions that have no state yet.''')
+spool_enqueuep.add_argument('spool', type=Path)
+spool_enqueuep.add_argument('--native-only', action='store_true')
+spool_enqueuep.set_defaults(func=spool_enqueue)
+spool_workp = spool_subp.add_parser('work', description='''Claim queued packages and write their state, until the queue is empty.''')
+spool_workp.add_argument('spool', type=Path)
+spool_workp.add_argument('--wait', action='store_true', help='keep waiting for new jobs instead of exiting when the queue is empty')
+spool_workp.add_argument('--stale-after', type=float, default=STALE_AFTER, help='seconds without heartbeat after which a claim is considered abandoned')
+spool_workp.set_defaults(func=spool_work)
+spool_statusp = spool_subp.add_parser('status', description='''Show how many jobs are pending, claimed, done and failed.''')
+spool_statusp.add_argument('spool', type=Path)
+spool_statusp.set_defaults(func=spool_status)
+
 args = p.parse_args()
 
 if args.arch is None:
-    arch = check_output(['uname', '-a']).decode('utf-8').split()[-2]
+    arch = os.uname().machine
 else:
     arch = args.arch
 
@@ -906,4 +1286,10 @@ log.init(args.quiet, log_level)
 if not 'func' in args:
     p.print_help()
     exit(1)
-args.func(args)
+
+governor.install(Governor(args.max_read_rate, args.max_iops, args.max_load, args.max_io_pressure, args.idle_io, args.nice))
+try:
+    args.func(args)
+finally:
+    if governor.current() is not None:
+        governor.current().report()
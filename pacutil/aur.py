@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import time
+import urllib.parse
+
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import logging as log
+from .util import mkdir_p, temp_dir, check_call, file_hash, atomic_open, write_atomic
+
+
+AUR_URL = 'https://aur.archlinux.org'
+RPC_VERSION = 5
+# the AUR rejects overly long request uris
+MAX_URL_LENGTH = 4000
+TIMEOUT = 30
+POOL_SIZE = 4
+
+# package caches of AUR helpers, <dir>/<pkgbase>/{PKGBUILD,*.pkg.tar.*}
+AUR_HELPER_CACHES = [Path.home() / '.cache' / 'yay', Path.home() / '.cache' / 'paru' / 'clone']
+
+pkgver_func_reg = re.compile(r'^\s*(?:function\s+)?pkgver\s*\(\s*\)', re.MULTILINE)
+
+
+class AurException(Exception):
+    pass
+
+
+def _validators(meta):
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def _response_validators(r):
+    return dict(etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+
+
+class AurClient:
+    def __init__(self, cache_path, base_url=None, offline=False):
+        self.base_url = (base_url or AUR_URL).rstrip('/')
+        self.cache_path = Path(cache_path)
+        self.offline = offline
+        self.info_cache = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        for d in self.rpc_path, self.query_path, self.snapshot_path:
+            mkdir_p(d)
+
+    @property
+    def rpc_path(self):
+        return self.cache_path / 'rpc'
+
+    @property
+    def query_path(self):
+        return self.cache_path / 'rpc-queries'
+
+    @property
+    def snapshot_path(self):
+        return self.cache_path / 'snapshots'
+
+    def _rpc_url(self, pkgs):
+        query = [('v', RPC_VERSION), ('type', 'info')] + [('arg[]', pkg) for pkg in pkgs]
+        return '%s/rpc/?%s' % (self.base_url, urllib.parse.urlencode(query))
+
+    def _batches(self, pkgs):
+        batch = []
+        for pkg in pkgs:
+            if batch and len(self._rpc_url(batch + [pkg])) > MAX_URL_LENGTH:
+                yield batch
+                batch = []
+            batch.append(pkg)
+        if batch:
+            yield batch
+
+    def _cached_info(self, pkg):
+        f = self.rpc_path / (pkg + '.json')
+        if f.exists():
+            return json.loads(f.read_text())
+        return None
+
+    def _query(self, pkgs):
+        url = self._rpc_url(pkgs)
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        query_file = self.query_path / (key + '.json')
+        cached = json.loads(query_file.read_text()) if query_file.exists() else None
+
+        headers = _validators(cached) if cached else {}
+        log.info('AUR rpc info for %s packages' % len(pkgs))
+        r = self.session.get(url, headers=headers, timeout=TIMEOUT)
+        if r.status_code == 304 and cached:
+            log.debug('AUR rpc response not modified')
+            return cached['results']
+        if r.status_code != 200:
+            raise AurException('AUR rpc request failed with %s: %s' % (r.status_code, url))
+        body = r.json()
+        if body.get('type') == 'error':
+            raise AurException('AUR rpc error: %s' % body.get('error'))
+        results = body.get('results', [])
+        meta = _response_validators(r)
+        if any(meta.values()):
+            meta['results'] = results
+            write_atomic(query_file, json.dumps(meta).encode('utf-8'))
+        return results
+
+    def info(self, pkgs):
+        '''pkg -> rpc info for all given packages that are in the AUR, batched into few requests'''
+        missing = [pkg for pkg in pkgs if pkg not in self.info_cache]
+        offline = self.offline
+        if missing and not offline:
+            try:
+                for batch in self._batches(missing):
+                    for info in self._query(batch):
+                        pkg = info['Name']
+                        self.info_cache[pkg] = info
+                        write_atomic(self.rpc_path / (pkg + '.json'), json.dumps(info).encode('utf-8'))
+            except requests.RequestException as e:
+                log.warning('AUR not reachable, using cached package info: %s' % e)
+                offline = True
+        if offline:
+            for pkg in missing:
+                info = self.info_cache.get(pkg) or self._cached_info(pkg)
+                if info:
+                    self.info_cache[pkg] = info
+        return {pkg: self.info_cache[pkg] for pkg in pkgs if pkg in self.info_cache}
+
+    def pkg_info(self, pkg):
+        info = self.info([pkg]).get(pkg)
+        if not info:
+            raise AurException('Package %s not found in AUR at %s. (Did you install this package from a disabled pacman repo?)' % (pkg, self.base_url))
+        return info
+
+    def snapshot(self, pkg):
+        '''path of the snapshot tarball of pkg's current AUR version, downloaded only if not cached'''
+        info = self.pkg_info(pkg)
+        url = info.get('URLPath')
+        if not url:
+            raise AurException('no snapshot url for %s' % pkg)
+        url = urllib.parse.urljoin(self.base_url + '/', url)
+        name = Path(urllib.parse.urlsplit(url).path).name
+        tar_file = self.snapshot_path / ('%s-%s-%s' % (info['PackageBase'], info['Version'], name))
+        meta_file = tar_file.with_name(tar_file.name + '.json')
+        meta = json.loads(meta_file.read_text()) if meta_file.exists() else {}
+
+        if tar_file.exists() and (self.offline or not _validators(meta)):
+            return tar_file
+
+        headers = _validators(meta) if tar_file.exists() else {}
+        log.info('Getting snapshot from %s' % url)
+        try:
+            r = self.session.get(url, headers=headers, timeout=TIMEOUT, stream=True)
+        except requests.RequestException as e:
+            if tar_file.exists():
+                log.warning('AUR not reachable, using cached snapshot %s: %s' % (tar_file, e))
+                return tar_file
+            raise AurException('cannot download %s: %s' % (url, e))
+        with r:
+            if r.status_code == 304 and tar_file.exists():
+                return tar_file
+            if r.status_code != 200:
+                raise AurException('snapshot download failed with %s: %s' % (r.status_code, url))
+            with atomic_open(tar_file) as f:
+                for b in r.iter_content(chunk_size=64 * 1024):
+                    f.write(b)
+            meta = _response_validators(r)
+            meta['fetched'] = time.time()
+            write_atomic(meta_file, json.dumps(meta).encode('utf-8'))
+        return tar_file
+
+
+def pkg_file_info(p):
+    # name-pkgver-pkgrel-arch.pkg.tar.ext -> (name, pkgver-pkgrel, arch)
+    name = Path(p).name
+    if '.pkg.tar' not in name or name.endswith('.sig'):
+        return None
+    parts = name.split('.pkg.tar', 1)[0].rsplit('-', 3)
+    if len(parts) != 4:
+        return None
+    pkg, pkgver, pkgrel, arch = parts
+    return pkg, pkgver + '-' + pkgrel, arch
+
+
+def find_pkg_file(d, pkg, version=None, arch=None):
+    '''the most recently built matching package file in d'''
+    if not d.is_dir():
+        return None
+    found = []
+    for p in d.iterdir():
+        info = pkg_file_info(p)
+        if not info or info[0] != pkg:
+            continue
+        if version is not None and info[1] != version:
+            continue
+        if arch is not None and info[2] not in (arch, 'any'):
+            continue
+        found.append(p)
+    return max(found, key=lambda p: p.stat().st_mtime, default=None)
+
+
+def defines_pkgver(pkgbuild):
+    # VCS packages compute their version when built, it need not match the AUR's
+    return bool(pkgver_func_reg.search(Path(pkgbuild).read_text(errors='replace')))
+
+
+def extract_snapshot(tar_file, dst):
+    with tarfile.open(str(tar_file)) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(str(dst), filter='data')
+        else:
+            tar.extractall(str(dst))
+
+
+class BuildCache:
+    '''built AUR packages keyed by (pkg, version, arch, PKGBUILD hash)'''
+    def __init__(self, cache_path, helper_caches=AUR_HELPER_CACHES):
+        self.cache_path = Path(cache_path)
+        self.helper_caches = helper_caches
+        mkdir_p(self.cache_path)
+
+    def entry_path(self, pkg, version, arch, pkgbuild_hash):
+        return self.cache_path / pkg / ('%s-%s-%s' % (version, arch, pkgbuild_hash[:16])).replace(':', '_')
+
+    def find(self, pkgbase, pkg, version, arch, pkgbuild_hash):
+        # the version in the file name may differ from the AUR version, e.g. when pkgver() of a VCS package
+        # ran, the entry is keyed by the AUR version and the PKGBUILD hash already
+        p = find_pkg_file(self.entry_path(pkg, version, arch, pkgbuild_hash), pkg, arch=arch)
+        if p:
+            return p
+        # reuse what an AUR helper built from the very same PKGBUILD
+        for d in self.helper_caches:
+            d = d / pkgbase
+            pkgbuild = d / 'PKGBUILD'
+            if not pkgbuild.exists() or file_hash(str(pkgbuild)) != pkgbuild_hash:
+                continue
+            # an older build left in the helper's dir is only acceptable if pkgver() would pick the version anyway
+            p = find_pkg_file(d, pkg, None if defines_pkgver(pkgbuild) else version, arch)
+            if p:
+                log.info('using %s from AUR helper cache' % p)
+                return self.add(p, pkg, version, arch, pkgbuild_hash)
+        return None
+
+    def add(self, pkg_file, pkg, version, arch, pkgbuild_hash):
+        d = self.entry_path(pkg, version, arch, pkgbuild_hash)
+        mkdir_p(d)
+        dst = d / pkg_file.name
+        with pkg_file.open('rb') as src, atomic_open(dst) as f:
+            shutil.copyfileobj(src, f)
+        return dst
+
+    def build(self, pkgbuild_dir, pkgbase, pkg, version, arch):
+        '''path to the built package file of pkg, runs makepkg only on a cache miss'''
+        pkgbuild_hash = file_hash(str(pkgbuild_dir / 'PKGBUILD'))
+        p = self.find(pkgbase, pkg, version, arch, pkgbuild_hash)
+        if p:
+            log.info('using cached build %s' % p)
+            return p
+
+        # unique dirs per job so builds can run concurrently
+        build_dir = temp_dir('makepkg-pacutil-%s-' % pkg)
+        pkgdest = temp_dir('pkgdest-%s-' % pkg)
+        env = dict(os.environ, BUILDDIR=str(build_dir), PKGDEST=str(pkgdest))
+        try:
+            try:
+                check_call(['makepkg', '-sr', '--asdeps', '--noconfirm'], cwd=str(pkgbuild_dir), env=env)
+            except subprocess.CalledProcessError as e:
+                raise AurException('building %s failed: %s' % (pkg, e))
+            built = find_pkg_file(pkgdest, pkg, arch=arch)
+            if not built:
+                raise AurException('makepkg did not build %s' % pkg)
+            built_version = pkg_file_info(built)[1]
+            if built_version != version:
+                log.info('%s built as version %s instead of %s' % (pkg, built_version, version))
+            return self.add(built, pkg, version, arch, pkgbuild_hash)
+        finally:
+            shutil.rmtree(str(build_dir), ignore_errors=True)
+            shutil.rmtree(str(pkgdest), ignore_errors=True)
@@ -0,0 +1,104 @@
+import atexit
+import os
+import queue
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from . import logging as log
+from .util import mkdir_p, check_call, chmod, file_hash
+
+
+class ChrootPool:
+    '''fixed set of chroot directories that are recycled between package installs
+
+    Releasing a chroot moves its contents out of the way and deletes them on a background
+    worker, so the next install can start right away.'''
+    def __init__(self, base_path, size=2):
+        self.base_path = Path(base_path).absolute()
+        self.free = queue.Queue()
+        self.teardown = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.ntrash = 0
+        mkdir_p(self.base_path)
+        for i in range(size):
+            slot = self.base_path / ('slot-%s' % i)
+            self._prepare(slot)
+            self.free.put(slot)
+        atexit.register(self.close)
+
+    def _prepare(self, slot):
+        mkdir_p(slot / 'etc' / 'pacman.d')
+
+    def _recycle(self, slot):
+        self.ntrash += 1
+        trash = self.base_path / ('.trash-%s' % self.ntrash)
+        try:
+            os.rename(str(slot), str(trash))
+        except OSError:
+            check_call(['sudo', 'mv', str(slot), str(trash)])
+        self._prepare(slot)
+        self.pending = [f for f in self.pending if not f.done()]
+        self.pending.append(self.teardown.submit(self._remove, trash))
+
+    def _remove(self, trash):
+        try:
+            check_call(['sudo', 'rm', '-rf', '--one-file-system', str(trash)])
+        except subprocess.CalledProcessError as e:
+            log.warning('cannot remove %s: %s' % (trash, e))
+
+    @contextmanager
+    def chroot(self):
+        slot = self.free.get()
+        try:
+            yield slot
+        finally:
+            self._recycle(slot)
+            self.free.put(slot)
+
+    def close(self):
+        for f in self.pending:
+            f.result()
+        self.pending = []
+        self.teardown.shutdown(wait=True)
+
+
+def _listdir(d):
+    try:
+        return list(os.scandir(d))
+    except PermissionError:
+        # pacstrap runs as root, only open up directories we actually need to read
+        chmod('o+rx', d, sudo=True, recursive=False)
+        return list(os.scandir(d))
+
+
+def walk_files(root):
+    '''all files below root, relative to it'''
+    root = str(root)
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        for e in _listdir(d):
+            if e.is_dir(follow_symlinks=False):
+                stack.append(e.path)
+            elif e.is_file():
+                yield Path(os.path.relpath(e.path, root))
+
+
+def make_accessible(root, rel):
+    # grant access to the directories leading to root / rel
+    d = Path(root)
+    for part in Path(rel).parent.parts:
+        d = d / part
+        if not os.access(str(d), os.R_OK | os.X_OK):
+            chmod('o+rx', d, sudo=True, recursive=False)
+
+
+def chroot_file_hash(p):
+    try:
+        return file_hash(str(p))
+    except PermissionError:
+        chmod('o+r', p, sudo=True, recursive=False)
+        return file_hash(str(p))
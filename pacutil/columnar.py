@@ -0,0 +1,96 @@
+import numpy as np
+
+from .state import DIGEST_SIZE, PkgState
+
+
+BATCH_SIZE = 64 * 1024
+
+
+def _digest_rows(digests):
+    # compare digests as 4 uint64 words, S32 comparisons would ignore trailing zero bytes
+    return digests.view(np.uint64).reshape(-1, DIGEST_SIZE // 8)
+
+
+class ColumnarState:
+    '''expected digests of the installed package versions as two columns sorted by path id
+
+    A path id is the node PkgState interned the path to, offset by the nodes of the packages
+    before it, so ids are exact. Digests are taken from the state as the binary S32 values it stores.'''
+    def __init__(self, ids, digests, path_ids):
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.digests = digests[order]
+        # path -> id, of the first package owning the path like FileIndex.state_owners
+        self.path_ids = path_ids
+
+    @classmethod
+    def from_state(cls, installed_pkgs, state):
+        columns = []
+        offset = 0
+        for pkg, version in installed_pkgs.items():
+            pkg_state = state.get(pkg)
+            if pkg_state is None or version not in pkg_state:
+                continue
+            if not isinstance(pkg_state, PkgState):
+                pkg_state = PkgState({version: pkg_state[version]})
+            nodes = pkg_state.digests(version)
+            ids = np.fromiter(nodes.keys(), dtype=np.int64, count=len(nodes)) + offset
+            columns.append((ids, b''.join(nodes.values()), pkg_state.paths, nodes))
+            offset += len(pkg_state.paths.nodes)
+        path_ids = {}
+        for ids, _, paths, nodes in reversed(columns):
+            path_ids.update(zip(map(paths.path, nodes), ids.tolist()))
+        if not columns:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype='S%s' % DIGEST_SIZE), path_ids)
+        ids = np.concatenate([c[0] for c in columns])
+        digests = np.frombuffer(b''.join(c[1] for c in columns), dtype='S%s' % DIGEST_SIZE)
+        return cls(ids, digests, path_ids)
+
+    @classmethod
+    def from_index(cls, index):
+        return cls.from_state(index.installed_pkgs, index.state)
+
+    def modified(self, ids, digests):
+        '''mask of the scanned (ids, digests) whose digest differs from the expected one'''
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+        pos = np.searchsorted(self.ids, ids)
+        pos[pos == len(self.ids)] = 0
+        known = self.ids[pos] == ids
+        differs = (_digest_rows(self.digests[pos]) != _digest_rows(digests)).any(axis=1)
+        return known & differs
+
+
+class BatchComparer:
+    '''collects scanned digests of state owned files and compares them in bulk as fixed width arrays'''
+    def __init__(self, columnar, batch_size=BATCH_SIZE):
+        self.columnar = columnar
+        self.batch_size = batch_size
+        self.pkgs = []
+        self.paths = []
+        self.digests = []
+        self.modified_files = []
+
+    def add(self, pkg, s, digest):
+        self.pkgs.append(pkg)
+        self.paths.append(s)
+        self.digests.append(digest)
+        if len(self.paths) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        n = len(self.paths)
+        if n:
+            ids = np.fromiter(map(self.columnar.path_ids.__getitem__, self.paths), dtype=np.int64, count=n)
+            # one conversion for the whole batch instead of one per digest
+            digests = np.frombuffer(bytes.fromhex(''.join(self.digests)), dtype='S%s' % DIGEST_SIZE)
+            mask = self.columnar.modified(ids, digests)
+            self.modified_files += [(self.pkgs[i], self.paths[i]) for i in np.flatnonzero(mask)]
+            self.pkgs = []
+            self.paths = []
+            self.digests = []
+
+    def result(self):
+        '''(pkg, path) of the modified files'''
+        self.flush()
+        return self.modified_files
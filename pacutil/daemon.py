@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+
+from pathlib import Path
+
+from . import logging as log
+from .hashcache import HashCache
+from .index import collect_files, scan_files
+
+
+REFRESH_INTERVAL = 5
+
+
+class DaemonException(Exception):
+    pass
+
+
+def default_socket_path():
+    d = os.getenv('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return Path(d) / ('pacutil-%s.sock' % os.getuid())
+
+
+def _mtime(p):
+    try:
+        return os.stat(str(p)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def classified_record(c):
+    return c._asdict()
+
+
+class Daemon:
+    '''keeps the file index and hash cache in memory and answers requests over a unix socket
+
+    The index is rebuilt whenever one of watched_paths changes, e.g. pacman's local db.'''
+    def __init__(self, load_index, watched_paths, socket_path, refresh_interval=REFRESH_INTERVAL):
+        self.load_index = load_index
+        self.watched_paths = list(watched_paths)
+        self.socket_path = Path(socket_path)
+        self.refresh_interval = refresh_interval
+        self.hash_cache = HashCache()
+        self.index = None
+        self.index_generation = None
+        self.lock = None
+
+    def generation(self):
+        return tuple(_mtime(p) for p in self.watched_paths)
+
+    async def refresh(self):
+        gen = self.generation()
+        if gen == self.index_generation:
+            return
+        async with self.lock:
+            if gen == self.index_generation:
+                return
+            log.info('loading index')
+            loop = asyncio.get_running_loop()
+            self.index = await loop.run_in_executor(None, self.load_index, self.hash_cache)
+            self.index_generation = gen
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.error('refreshing index failed: %s' % e)
+
+    def dispatch(self, index, req):
+        cmd = req.get('cmd')
+        if cmd == 'ping':
+            return dict(ok=True)
+        if cmd == 'check-files':
+            files = collect_files([Path(p) for p in req['paths']])
+            modified_files, orphan_files, uncheckable_files = scan_files(index, files)
+            return dict(modified=modified_files, orphans=orphan_files, uncheckable=uncheckable_files, pkgs=index.pkg_info())
+        if cmd == 'verify':
+            return dict(results=[classified_record(index.classify(Path(p))) for p in req['paths']])
+        raise DaemonException('unknown command %s' % cmd)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    req = json.loads(line.decode('utf-8'))
+                    await self.refresh()
+                    resp = await loop.run_in_executor(None, self.dispatch, self.index, req)
+                except Exception as e:
+                    log.error('request failed: %s' % e)
+                    resp = dict(error=str(e))
+                writer.write(json.dumps(resp).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.lock = asyncio.Lock()
+        await self.refresh()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        server = await asyncio.start_unix_server(self.handle, path=str(self.socket_path))
+        os.chmod(str(self.socket_path), 0o600)
+        log.message('listening on %s' % self.socket_path)
+        watcher = asyncio.ensure_future(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+
+def request(socket_path, req):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(str(socket_path))
+        s.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise DaemonException('no response from %s' % socket_path)
+    resp = json.loads(line.decode('utf-8'))
+    if 'error' in resp:
+        raise DaemonException(resp['error'])
+    return resp
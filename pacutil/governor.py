@@ -0,0 +1,195 @@
+import ctypes
+import os
+import platform
+import threading
+import time
+
+from collections import OrderedDict as odict
+
+from . import logging as log
+
+
+PSI_IO = '/proc/pressure/io'
+# how often load and pressure are looked at
+CHECK_INTERVAL = 1.0
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 10.0
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'riscv64': 30}
+
+_SIZE_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(s):
+    '''bytes of e.g. 512k or 50M'''
+    s = s.strip().lower().rstrip('b')
+    suffix = s[-1:] if s[-1:] in _SIZE_SUFFIXES else ''
+    return int(float(s[:len(s) - len(suffix)]) * _SIZE_SUFFIXES[suffix])
+
+
+def io_pressure():
+    '''share of the last 10s some task was stalled on io in percent, None without PSI'''
+    try:
+        with open(PSI_IO, 'r') as f:
+            for line in f:
+                if line.startswith('some '):
+                    return float(dict(kv.split('=') for kv in line.split()[1:])['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def load_per_cpu():
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def set_idle_io():
+    '''idle io priority for the calling thread and everything it starts'''
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        log.warning('idle io priority not supported on %s' % platform.machine())
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        e = ctypes.get_errno()
+        log.warning('cannot set idle io priority: %s' % os.strerror(e))
+        return False
+    return True
+
+
+class TokenBucket:
+    '''rate tokens per second with a burst of one second'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def delay(self, n):
+        # seconds to wait until n tokens are available, they are taken right away
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Governor:
+    '''keeps scans from hurting the workloads of the host they run on
+
+    Reads are limited to max_read_rate bytes and max_iops reads per second, and everything
+    pauses while the load per cpu or the io pressure is above its threshold. Worker threads
+    can be given idle io priority and a nice level.'''
+    def __init__(self, max_read_rate=None, max_iops=None, max_load=None, max_io_pressure=None, idle_io=False, nice=None,
+                 check_interval=CHECK_INTERVAL):
+        self.bandwidth = TokenBucket(max_read_rate) if max_read_rate else None
+        self.iops = TokenBucket(max_iops) if max_iops else None
+        self.max_load = max_load
+        self.max_io_pressure = max_io_pressure
+        self.idle_io = idle_io
+        self.nice = nice
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.last_check = 0
+        # every thread waits until then, the pause is doubled while the host stays busy
+        self.paused_until = 0
+        self.pause = MIN_BACKOFF
+        self.throttled = odict((reason, 0.0) for reason in ('bandwidth', 'iops', 'load', 'io pressure'))
+
+    @property
+    def limits_reads(self):
+        # reads must go through read(), in chunks and without read ahead
+        return self.bandwidth is not None or self.iops is not None
+
+    @property
+    def enabled(self):
+        return any((self.bandwidth, self.iops, self.max_load, self.max_io_pressure, self.idle_io, self.nice))
+
+    def init_thread(self):
+        '''lower the priority of the calling thread, also usable as ThreadPoolExecutor initializer'''
+        if self.idle_io:
+            set_idle_io()
+        if self.nice:
+            # on linux the priority of a single thread can be changed through its tid
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), min(19, os.getpriority(os.PRIO_PROCESS, 0) + self.nice))
+
+    def _account(self, reason, t):
+        with self.lock:
+            self.throttled[reason] += t
+
+    def _overloaded(self):
+        if self.max_load is not None and load_per_cpu() > self.max_load:
+            return 'load'
+        if self.max_io_pressure is not None:
+            pressure = io_pressure()
+            if pressure is not None and pressure > self.max_io_pressure:
+                return 'io pressure'
+        return None
+
+    def backoff(self):
+        '''wait while the host is busy, checked at most every check_interval
+
+        One thread checks, a pause it decides on is honored by all threads.'''
+        if self.max_load is None and self.max_io_pressure is None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                paused = self.paused_until - now
+                if paused <= 0 and now - self.last_check >= self.check_interval:
+                    # checked under the lock, so no thread reads on while the check decides on a pause
+                    self.last_check = now
+                    reason = self._overloaded()
+                    if reason is None:
+                        self.pause = MIN_BACKOFF
+                    else:
+                        log.debug('%s too high, pausing for %ss' % (reason, self.pause))
+                        paused = self.pause
+                        self.paused_until = now + paused
+                        # the scan is paused, not each thread
+                        self.throttled[reason] += paused
+                        self.pause = min(MAX_BACKOFF, self.pause * 2)
+                        # look again as soon as the pause is over
+                        self.last_check = 0
+            if paused <= 0:
+                return
+            time.sleep(paused)
+
+    def read(self, n):
+        '''called before reading n bytes, blocks as long as needed'''
+        self.backoff()
+        for reason, bucket, tokens in (('iops', self.iops, 1), ('bandwidth', self.bandwidth, n)):
+            if bucket is None:
+                continue
+            with self.lock:
+                delay = bucket.delay(tokens)
+            if delay:
+                time.sleep(delay)
+                self._account(reason, delay)
+
+    def report(self):
+        total = sum(self.throttled.values())
+        if total:
+            log.message('throttled for %.1fs (%s)' % (total, ', '.join('%s %.1fs' % kv for kv in self.throttled.items() if kv[1])))
+
+
+_current = None
+
+def install(governor):
+    '''governor for all hashing in this process'''
+    global _current
+    _current = governor if governor is not None and governor.enabled else None
+    if _current is not None:
+        _current.init_thread()
+
+
+def current():
+    return _current
+
+
+def init_worker():
+    '''ThreadPoolExecutor initializer for threads that hash files'''
+    if _current is not None:
+        _current.init_thread()
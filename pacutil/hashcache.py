@@ -0,0 +1,44 @@
+import os
+
+from .util import file_digests, file_digests_sudo
+
+
+SHA256 = 'sha256'
+MD5 = 'md5'
+
+
+def stat_signature(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class HashCache:
+    '''path -> {algorithm: digest}, reused as long as the file's stat signature is unchanged'''
+    def __init__(self, drop_cache=False, sudo=True):
+        self.entries = {}
+        self.drop_cache = drop_cache
+        # hash files we can't read with sudo, otherwise PermissionError is raised
+        self.sudo = sudo
+
+    def digests(self, path, algorithms, st=None):
+        '''the requested digests, those not cached yet are computed from a single read of the file'''
+        path = str(path)
+        if st is None:
+            st = os.stat(path)
+        sig = stat_signature(st)
+        e = self.entries.get(path)
+        if e is None or e[0] != sig:
+            e = (sig, {})
+            self.entries[path] = e
+        hs = e[1]
+        missing = tuple(a for a in algorithms if a not in hs)
+        if missing:
+            try:
+                hs.update(file_digests(path, missing, self.drop_cache))
+            except PermissionError:
+                if not self.sudo:
+                    raise
+                hs.update(file_digests_sudo(path, missing))
+        return {a: hs[a] for a in algorithms}
+
+    def get(self, path, st=None, algorithm=SHA256):
+        return self.digests(path, (algorithm,), st)[algorithm]
@@ -0,0 +1,274 @@
+import errno
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from collections import OrderedDict as odict, namedtuple
+from pathlib import Path, PurePosixPath
+
+from . import logging as log
+from . import governor
+from .hashcache import HashCache, SHA256, MD5
+from .pacman import UNMODIFIED
+from .pacmandb import backup_status
+from .util import startswith_any, clean_glob
+
+
+UNMODIFIED_FILE = 'unmodified'
+MODIFIED_FILE = 'modified'
+UNCHECKABLE_FILE = 'uncheckable'
+ORPHAN_FILE = 'orphan'
+IGNORED_FILE = 'ignored'
+MISSING_FILE = 'missing'
+# hashed, but the comparison against the state is left to the caller
+UNCOMPARED_FILE = 'uncompared'
+
+
+class IndexException(Exception):
+    pass
+
+
+MAX_SYMLINKS = 40
+
+Classified = namedtuple('Classified', ['path', 'cls', 'pkg', 'version', 'expected', 'actual'])
+
+
+def resolve_in_root(root, p):
+    '''like Path.resolve for the path p inside root, absolute symlinks stay within root'''
+    parts = list(PurePosixPath(p).parts[1:])
+    resolved = []
+    links = 0
+    while parts:
+        name = parts.pop(0)
+        if name == '.':
+            continue
+        if name == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        real = os.path.join(root, *resolved, name)
+        if not os.path.islink(real):
+            resolved.append(name)
+            continue
+        links += 1
+        if links > MAX_SYMLINKS:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), str(p))
+        target = PurePosixPath(os.readlink(real))
+        if target.is_absolute():
+            resolved = []
+            parts = list(target.parts[1:]) + parts
+        else:
+            parts = list(target.parts) + parts
+    return '/' + '/'.join(resolved)
+
+
+class ReferenceCache:
+    '''the paths of package versions, shared by the indexes of roots that have many of the same versions installed'''
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            e = self.entries.get(key)
+        if e is None:
+            # built outside the lock so roots don't wait for each other, building twice is harmless
+            e = build()
+            with self.lock:
+                e = self.entries.setdefault(key, e)
+        return e
+
+
+def _package_paths(references, key, files):
+    if references is None:
+        return files
+    return references.get(key, lambda: tuple(files))
+
+
+def _owners(entries):
+    # entries of (pkg, version, files), the first package owning a file wins
+    r = {}
+    for pkg, version, files in reversed(entries):
+        r.update(dict.fromkeys(files, (pkg, version)))
+    return r
+
+
+def state_owner_map(installed_pkgs, state, references=None):
+    # assume pacman ensures that no two packages may own the same file
+    return _owners([(pkg, version, _package_paths(references, ('state', pkg, version), state[pkg][version]))
+                    for pkg, version in installed_pkgs.items() if pkg in state and version in state[pkg]])
+
+
+def owner_map(owned_files, references=None):
+    return _owners([(pkg, version, _package_paths(references, ('owned', pkg, version), fs))
+                    for pkg, versions in owned_files.items() for version, fs in versions.items()])
+
+
+class FileIndex:
+    '''lookups from file path to owning package, built once from pacman's data and the state
+
+    With root, paths are those of the system installed below root, e.g. an image or a container,
+    and references is a ReferenceCache shared by the indexes of several roots.'''
+    def __init__(self, installed_pkgs, installed_native_pkgs, state, backup_files, owned_files, ignored_paths=(), hash_cache=None,
+                 root=None, references=None):
+        self.installed_pkgs = installed_pkgs
+        self.installed_native_pkgs = installed_native_pkgs
+        self.state = state
+        self.ignored_paths = ignored_paths
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache()
+        self.root = str(root) if root is not None else None
+
+        self.state_owners = state_owner_map(installed_pkgs, state, references)
+        self.owners = owner_map(owned_files, references)
+
+        # backup files are verified against the md5 pacman recorded for them, as pacman -Qii does
+        self.config_owners = {}
+        self.backup_md5 = {}
+        for pkg, versions in backup_files.items():
+            for version, backup in versions.items():
+                for f, md5 in backup:
+                    self.config_owners.setdefault(f, (pkg, version))
+                    self.backup_md5.setdefault(f, md5)
+
+    def has_state(self, pkg):
+        return pkg in self.state and self.installed_pkgs.get(pkg) in self.state[pkg]
+
+    def pkg_info(self):
+        return odict((pkg, dict(version=version, native=pkg in self.installed_native_pkgs, has_state=self.has_state(pkg)))
+                     for pkg, version in self.installed_pkgs.items())
+
+    def digest_algorithms(self, s):
+        '''the digests the references for s are stored as, so they can all be computed from one read'''
+        algorithms = []
+        if s in self.state_owners:
+            algorithms.append(SHA256)
+        if s in self.backup_md5:
+            algorithms.append(MD5)
+        return algorithms
+
+    def real_path(self, s):
+        # where the file at s is on disk
+        return s if self.root is None else os.path.join(self.root, s.lstrip('/'))
+
+    def file_digests(self, s):
+        return self.hash_cache.digests(self.real_path(s), self.digest_algorithms(s))
+
+    def config_status(self, s):
+        '''MODIFIED or UNMODIFIED like pacman -Qii for a backup file, None if s is not a backup file or can't be read'''
+        if s not in self.backup_md5:
+            return None
+        return backup_status(self.backup_md5[s], lambda: self.file_digests(s)[MD5])
+
+    def classify(self, p, compare=True):
+        p = Path(p)
+        presolved = p.resolve() if self.root is None else Path(resolve_in_root(self.root, p))
+
+        # don't filter earlier as resolve is expensive
+        if startswith_any(str(p), self.ignored_paths) or startswith_any(str(presolved), self.ignored_paths):
+            return Classified(str(p), IGNORED_FILE, None, None, None, None)
+
+        p = presolved
+        s = str(p)
+        if not os.path.isfile(self.real_path(s)):
+            return Classified(s, MISSING_FILE, None, None, None, None)
+
+        r = self.state_owners.get(s)
+        if r:
+            # pacman knows the file and we've seen it before
+            pkg, version = r
+            hash = self.file_digests(s)[SHA256]
+            if not compare:
+                return Classified(s, UNCOMPARED_FILE, pkg, version, None, hash)
+            phash = self.state[pkg][version][s]
+            cls = UNMODIFIED_FILE if hash == phash else MODIFIED_FILE
+            return Classified(s, cls, pkg, version, phash, hash)
+
+        # pacman knows this as an unmodified config file
+        r = self.config_owners.get(s)
+        if r and self.config_status(s) == UNMODIFIED:
+            return Classified(s, UNMODIFIED_FILE, r[0], r[1], None, None)
+
+        r = self.owners.get(s)
+        if r:
+            return Classified(s, UNCHECKABLE_FILE, r[0], r[1], None, None)
+        return Classified(s, ORPHAN_FILE, None, None, None, None)
+
+
+def iter_files(checked_paths):
+    '''the files below checked_paths, as the walk finds them'''
+    for d in checked_paths:
+        if Path(d).is_file():
+            yield Path(d)
+        else:
+            yield from clean_glob(Path(d))
+
+
+def collect_files(checked_paths):
+    return list(iter_files(checked_paths))
+
+
+# files handed to the worker threads at once
+CLASSIFY_CHUNK = 1024
+
+
+def classify_files(index, files, jobs=1, compare=True):
+    '''index.classify of every file in order, hashing in jobs threads'''
+    if jobs <= 1:
+        for p in files:
+            yield index.classify(p, compare)
+        return
+    classify = lambda p: index.classify(p, compare)
+    with ThreadPoolExecutor(jobs, initializer=governor.init_worker) as executor:
+        chunk = []
+        for p in files:
+            chunk.append(p)
+            if len(chunk) == CLASSIFY_CHUNK:
+                yield from executor.map(classify, chunk)
+                chunk = []
+        yield from executor.map(classify, chunk)
+
+
+def package_files(index, pkgs=None):
+    '''the files pacman says pkgs own, all installed packages if pkgs is None'''
+    if pkgs is not None:
+        unknown = [pkg for pkg in pkgs if pkg not in index.installed_pkgs]
+        if unknown:
+            raise IndexException('not installed: %s' % ', '.join(unknown))
+        pkgs = set(pkgs)
+    # pacman -Ql lists directories with a trailing slash
+    return [Path(f) for f, (pkg, _) in index.owners.items() if not f.endswith('/') and (pkgs is None or pkg in pkgs)]
+
+
+def scan_files(index, files, progress_every=None, jobs=1, comparer=None):
+    '''comparer, e.g. a columnar.BatchComparer, compares the digests of state owned files in bulk'''
+    orphan_files = []
+    modified_files = odict()
+    uncheckable_files = []
+
+    start_time = time.perf_counter()
+    last_time = start_time
+    for ifile, c in enumerate(classify_files(index, files, jobs, compare=comparer is None)):
+        now = time.perf_counter()
+        if progress_every and now - last_time > progress_every:
+            last_time = now
+            log.debug('%s%%' % int(ifile / len(files) * 100), )
+
+        if c.cls == UNCOMPARED_FILE:
+            comparer.add(c.pkg, c.path, c.actual)
+        elif c.cls == MODIFIED_FILE:
+            modified_files.setdefault(c.pkg, [])
+            modified_files[c.pkg].append(c.path)
+        elif c.cls == UNCHECKABLE_FILE:
+            uncheckable_files.append((c.path, (c.pkg, c.version)))
+        elif c.cls == ORPHAN_FILE:
+            orphan_files.append(c.path)
+
+    if comparer is not None:
+        for pkg, s in comparer.result():
+            modified_files.setdefault(pkg, [])
+            modified_files[pkg].append(s)
+
+    modified_files = odict(sorted([fs for fs in modified_files.items()], key=lambda fs: fs[0]))
+    return modified_files, orphan_files, uncheckable_files
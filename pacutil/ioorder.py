@@ -0,0 +1,107 @@
+import ctypes
+import fcntl
+import os
+import struct
+
+
+IO_ORDERS = ('walk', 'inode', 'extent')
+BATCH_SIZE = 4096
+
+FS_IOC_FIEMAP = 0xC020660B
+_fiemap = struct.Struct('QQIIII')
+_fiemap_extent = struct.Struct('QQQQQIIII')
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def first_extent(fd):
+    '''physical byte offset of the first extent of fd, or None if the filesystem can't tell'''
+    buf = bytearray(_fiemap.size + _fiemap_extent.size)
+    _fiemap.pack_into(buf, 0, 0, 0xffffffffffffffff, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    if not _fiemap.unpack_from(buf, 0)[3]:
+        # no extents, e.g. empty or inline files
+        return None
+    return _fiemap_extent.unpack_from(buf, _fiemap.size)[1]
+
+
+def _sort_key(p, order, root=None):
+    # sorting on (device, 0, physical offset), files without extent information go after those by inode
+    if root is not None:
+        p = os.path.join(root, str(p).lstrip('/'))
+    try:
+        st = os.stat(str(p))
+    except OSError:
+        return (0, 0, 0)
+    if order == 'extent':
+        try:
+            fd = os.open(str(p), os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        except OSError:
+            pass
+        else:
+            try:
+                physical = first_extent(fd)
+            finally:
+                os.close(fd)
+            if physical is not None:
+                return (st.st_dev, 0, physical)
+    return (st.st_dev, 1, st.st_ino)
+
+
+class Ordered:
+    '''files in batches of batch_size, each batch sorted by inode or physical extent to turn random seeks into sweeps
+
+    With root, files are paths inside the system installed below root.'''
+    def __init__(self, files, order, root=None, batch_size=BATCH_SIZE):
+        assert order in IO_ORDERS
+        self.files = files
+        self.order = order
+        self.root = root
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        if self.order == 'walk':
+            yield from self.files
+            return
+        for i in range(0, len(self.files), self.batch_size):
+            batch = self.files[i:i + self.batch_size]
+            yield from sorted(batch, key=lambda p: _sort_key(p, self.order, self.root))
+
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.mmap.restype = ctypes.c_void_p
+        _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    return _libc
+
+
+def resident(fd, size):
+    '''whether any page of the first size bytes of fd is in the page cache'''
+    if not size:
+        return False
+    libc = _get_libc()
+    addr = libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+    if addr is None or addr == MAP_FAILED:
+        # can't tell, assume cached so it isn't evicted
+        return True
+    try:
+        vec = ctypes.create_string_buffer((size + os.sysconf('SC_PAGE_SIZE') - 1) // os.sysconf('SC_PAGE_SIZE'))
+        if libc.mincore(addr, size, vec) != 0:
+            return True
+        return any(b & 1 for b in vec.raw)
+    finally:
+        libc.munmap(addr, size)
@@ -1,11 +1,7 @@
 import logging
+import sys
 from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
 
-try:
-    import coloredlogs
-except ImportError:
-    pass
-
 DEBUG = 'debug'
 INFO = 'info'
 WARNING = 'warning'
@@ -18,19 +14,33 @@ _loglevels = { DEBUG: logging.DEBUG, INFO: logging.INFO, WARNING: logging.WARNIN
 message = lambda *args: print(*args)
 debug = info = lambda *args: None
 warning = error = critical = lambda *args: print(*args)
+_quiet = False
 
 def init(quiet, log_level):
-    global message, debug, info, warning, error, critical
+    global message, debug, info, warning, error, critical, _quiet
+    _quiet = quiet
     if quiet:
-        print('quiet mode')
+        # stdout may carry machine readable output
+        print('quiet mode', file=sys.stderr)
         log_level = WARNING
         message = debug
 
     log_level = _loglevels[log_level]
 
-    coloredlogs.install(level=log_level)
+    try:
+        import coloredlogs
+        coloredlogs.install(level=log_level)
+    except ImportError:
+        logging.basicConfig(level=log_level)
     # import after basicConfig / install
 
     debug, info, warning, error, critical = logging.debug, logging.info, logging.warning, logging.error, logging.critical
 
     
+
+
+def messages_to_stderr():
+    # keep stdout free for machine readable output
+    global message
+    if not _quiet:
+        message = lambda *args: print(*args, file=sys.stderr)
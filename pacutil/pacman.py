@@ -0,0 +1,160 @@
+import asyncio
+import os
+import re
+import subprocess
+
+from collections import OrderedDict as odict
+from pathlib import Path
+
+from . import logging as log
+from .util import check_output
+
+
+MODIFIED = 0
+UNMODIFIED = 1
+PACMAN_CFG_FILE_LIST_CMD = ['pacman', '-Qii']
+PACMAN_LOCAL_DB = Path('/var/lib/pacman/local')
+
+name_reg = re.compile(r'Name *: (.*)')
+ver_reg = re.compile(r'Version *: (.*)')
+f_reg = re.compile(r'((?:UN)?MODIFIED)[ \t]*(.*)')
+
+
+def local_db_generation():
+    # changes whenever a package is installed, upgraded or removed
+    return os.stat(str(PACMAN_LOCAL_DB)).st_mtime_ns
+
+
+# parsers are fed pacman's output line by line, so output can be parsed while it arrives
+
+class VersionsParser:
+    def __init__(self):
+        self.name = None
+        self.r = odict()
+
+    def feed(self, l):
+        m = name_reg.match(l)
+        if m:
+            self.name = m.group(1)
+        elif self.name:
+            m = ver_reg.match(l)
+            if m:
+                self.r[self.name] = m.group(1)
+
+    def result(self):
+        return self.r
+
+
+class ConfigFilesParser:
+    def __init__(self):
+        self.name = None
+        self.ver = None
+        self.fs = []
+        self.r = odict()
+
+    def flush(self):
+        if self.name and self.fs:
+            assert(self.ver is not None)
+            self.r.setdefault(self.name, odict())
+            self.r[self.name].setdefault(self.ver, [])
+            self.r[self.name][self.ver] += self.fs
+            self.fs = []
+
+    def feed(self, l):
+        m = name_reg.match(l)
+        if m:
+            self.flush()
+            self.name = m.group(1)
+        elif self.name:
+            m = ver_reg.match(l)
+            if m:
+                self.ver = m.group(1)
+            else:
+                m = f_reg.match(l)
+                if m:
+                    state = UNMODIFIED if m.group(1).startswith('UN') else MODIFIED
+                    self.fs.append((state, m.group(2)))
+
+    def result(self):
+        self.flush()
+        return self.r
+
+
+class InstalledPkgsParser:
+    def __init__(self):
+        self.r = odict()
+
+    def feed(self, l):
+        if l:
+            pkg, version = l.split(' ')
+            self.r[pkg] = version
+
+    def result(self):
+        return self.r
+
+
+def parse(parser, s):
+    for l in s.split('\n'):
+        parser.feed(l)
+    return parser
+
+
+def pacman_get_versions(chroot_path=None):
+    return parse(VersionsParser(), check_output(PACMAN_CFG_FILE_LIST_CMD, universal_newlines=True, cwd=chroot_path)).result()
+
+
+def get_config_files(pkgs=()):
+    return parse(ConfigFilesParser(), check_output(PACMAN_CFG_FILE_LIST_CMD + list(pkgs), universal_newlines=True)).result()
+
+
+def parse_installed_packages(s):
+    return parse(InstalledPkgsParser(), s).result()
+
+
+def get_installed_pkgs(native_only=False):
+    flags = '-Q'
+    if native_only:
+        flags += 'n'
+    return parse_installed_packages(check_output(['pacman', flags], universal_newlines=True))
+
+
+async def run_parse(cmd, parser):
+    '''run cmd and feed its output to parser line by line as it arrives'''
+    log.debug(' '.join(cmd))
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+    async for line in proc.stdout:
+        parser.feed(line.decode('utf-8', 'surrogateescape').rstrip('\n'))
+    returncode = await proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return parser
+
+
+def root_args(root):
+    # make pacman look at the system installed below root
+    if root is None:
+        return []
+    return ['--root', str(root), '--dbpath', str(Path(root) / 'var/lib/pacman')]
+
+
+async def query_native(root=None):
+    '''pkg -> version of the installed packages found in the sync dbs'''
+    parser = InstalledPkgsParser()
+    try:
+        await run_parse(['pacman'] + root_args(root) + ['-Qn'], parser)
+    except subprocess.CalledProcessError as e:
+        # -Qn fails when nothing matches, e.g. in a root whose sync dbs were never downloaded
+        if e.returncode != 1 or parser.r:
+            raise
+    return parser.result()
+
+
+async def query_pacman(local_db, owned_files=True, root=None):
+    '''(installed pkgs, native pkgs, backup files, owned files or None)
+
+    Everything but -Qn is read from the pacmandb.LocalDb's snapshot, backup files as pkg -> {version: [(path, md5)]}
+    so they can be verified while hashing. -Qn depends on the sync dbs, it runs concurrently.'''
+    loop = asyncio.get_running_loop()
+    native, local_db = await asyncio.gather(query_native(root), loop.run_in_executor(None, local_db.load))
+    owned = local_db.owned_files() if owned_files else None
+    return local_db.installed_pkgs(), native, local_db.backup_files(), owned
@@ -0,0 +1,163 @@
+import marshal
+import os
+import sys
+
+from collections import OrderedDict as odict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import logging as log
+from . import governor
+from .hashcache import HashCache, MD5
+from .pacman import PACMAN_LOCAL_DB, MODIFIED, UNMODIFIED
+from .util import mkdir_p, atomic_open
+
+
+FORMAT_VERSION = 1
+# marshal's format may change between python versions
+SNAPSHOT_HEADER = ('pacutil-pacmandb', FORMAT_VERSION, tuple(sys.version_info[:2]))
+BACKUP_JOBS = 8
+
+
+def parse_sections(s):
+    '''%SECTION% headers followed by one value per line up to an empty line, as in the local db's desc and files'''
+    r = {}
+    section = None
+    for l in s.split('\n'):
+        if not l:
+            section = None
+        elif section is None and l.startswith('%') and l.endswith('%'):
+            section = r.setdefault(l[1:-1], [])
+        elif section is not None:
+            section.append(l)
+    return r
+
+
+def _mtime(f):
+    try:
+        return os.stat(f).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def parse_pkg_dir(d):
+    '''(name, version, files, backup) of one package directory of the local db
+
+    files is a single string of '\\n' separated absolute paths, directories end in '/' as with pacman -Ql,
+    backup a tuple of (absolute path, md5) of its backup files.'''
+    with open(os.path.join(d, 'desc'), 'r', encoding='utf-8', errors='surrogateescape') as f:
+        desc = parse_sections(f.read())
+    try:
+        with open(os.path.join(d, 'files'), 'r', encoding='utf-8', errors='surrogateescape') as f:
+            files = parse_sections(f.read())
+    except FileNotFoundError:
+        files = {}
+    backup = []
+    for l in files.get('BACKUP', ()):
+        path, md5 = l.rsplit('\t', 1)
+        backup.append(('/' + path, md5))
+    return desc['NAME'][0], desc['VERSION'][0], '\n'.join('/' + f for f in files.get('FILES', ())), tuple(backup)
+
+
+class LocalDb:
+    '''the parsed contents of pacman's local db, persisted as a snapshot
+
+    Each package directory is only parsed again when the mtime of its desc or files changed,
+    so after an upgrade only the upgraded packages are read.'''
+    def __init__(self, snapshot_path, db_path=PACMAN_LOCAL_DB):
+        self.snapshot_path = Path(snapshot_path)
+        self.db_path = Path(db_path)
+        self.db_mtime = None
+        # package dir name -> (desc mtime, files mtime, name, version, files, backup)
+        self.entries = {}
+
+    def _load_snapshot(self):
+        try:
+            with self.snapshot_path.open('rb') as f:
+                header, db_mtime, entries = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            if self.snapshot_path.exists():
+                log.warning('ignoring unreadable pacman db snapshot %s: %s' % (self.snapshot_path, e))
+            return
+        if header == SNAPSHOT_HEADER:
+            self.db_mtime, self.entries = db_mtime, entries
+
+    def _save_snapshot(self):
+        mkdir_p(self.snapshot_path.parent)
+        with atomic_open(self.snapshot_path) as f:
+            marshal.dump((SNAPSHOT_HEADER, self.db_mtime, self.entries), f)
+
+    def load(self):
+        self._load_snapshot()
+        db_mtime = os.stat(str(self.db_path)).st_mtime_ns
+        entries = {}
+        parsed = 0
+        with os.scandir(str(self.db_path)) as it:
+            for e in it:
+                if not e.is_dir():
+                    continue
+                desc_mtime = _mtime(os.path.join(e.path, 'desc'))
+                if desc_mtime is None:
+                    continue
+                files_mtime = _mtime(os.path.join(e.path, 'files'))
+                old = self.entries.get(e.name)
+                if old is not None and old[0] == desc_mtime and old[1] == files_mtime:
+                    entries[e.name] = old
+                else:
+                    entries[e.name] = (desc_mtime, files_mtime) + parse_pkg_dir(e.path)
+                    parsed += 1
+        changed = parsed or db_mtime != self.db_mtime or len(entries) != len(self.entries)
+        self.db_mtime, self.entries = db_mtime, entries
+        if changed:
+            log.debug('parsed %s of %s packages of the local db' % (parsed, len(entries)))
+            self._save_snapshot()
+        return self
+
+    def _packages(self):
+        # sorted by name like pacman's own output
+        return sorted((e[2:] for e in self.entries.values()), key=lambda e: e[0])
+
+    def installed_pkgs(self):
+        return odict((name, version) for name, version, _, _ in self._packages())
+
+    def owned_files(self):
+        '''pkg -> {version: files}, files as listed by pacman -Ql'''
+        return odict((name, odict([(version, files.split('\n') if files else [])])) for name, version, files, _ in self._packages())
+
+    def backup_files(self):
+        '''pkg -> {version: [(path, md5)]}'''
+        return odict((name, odict([(version, list(backup))])) for name, version, _, backup in self._packages() if backup)
+
+    def config_files(self, root=None, hash_cache=None):
+        '''the MODIFIED/UNMODIFIED status of backup files pacman -Qii would report, without running it'''
+        return verify_backup_files(self.backup_files(), root, hash_cache)
+
+
+def backup_status(md5, actual_md5):
+    '''MODIFIED or UNMODIFIED like pacman -Qii, None where pacman reports MISSING or UNREADABLE
+
+    actual_md5 computes the md5 of the file as it is now.'''
+    try:
+        actual = actual_md5()
+    except (FileNotFoundError, NotADirectoryError, PermissionError, IsADirectoryError):
+        return None
+    return UNMODIFIED if actual == md5 else MODIFIED
+
+
+def verify_backup_files(backup_files, root=None, hash_cache=None, jobs=BACKUP_JOBS):
+    '''pkg -> {version: [(MODIFIED or UNMODIFIED, path)]} from backup_files' recorded md5s, as get_config_files
+
+    Files are hashed in jobs threads. Like pacman run without privileges, files we can't read are left out.'''
+    if hash_cache is None:
+        hash_cache = HashCache(sudo=False)
+    entries = [(pkg, version, path, md5) for pkg, versions in backup_files.items()
+               for version, backup in versions.items() for path, md5 in backup]
+    real = lambda path: path if root is None else os.path.join(str(root), path.lstrip('/'))
+    status = lambda e: backup_status(e[3], lambda: hash_cache.get(real(e[2]), algorithm=MD5))
+    with ThreadPoolExecutor(jobs, initializer=governor.init_worker) as executor:
+        statuses = list(executor.map(status, entries))
+    r = odict()
+    for (pkg, version, path, _), changed in zip(entries, statuses):
+        if changed is not None:
+            r.setdefault(pkg, odict()).setdefault(version, []).append((changed, path))
+    return r
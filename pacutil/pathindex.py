@@ -0,0 +1,87 @@
+import sqlite3
+
+from pathlib import Path
+
+from .hashcache import SHA256, MD5
+from .index import Classified, UNMODIFIED_FILE, MODIFIED_FILE, UNCHECKABLE_FILE, ORPHAN_FILE, IGNORED_FILE, MISSING_FILE
+from .pacman import UNMODIFIED
+from .pacmandb import backup_status
+from .util import startswith_any, mkdir_p
+
+
+# bumped whenever the tables change, older indexes are dropped and rebuilt
+SCHEMA_VERSION = 2
+SCHEMA = '''
+create table if not exists meta (key text primary key, value text) without rowid;
+create table if not exists files (
+    path text primary key,
+    pkg text not null,
+    version text not null,
+    digest blob,
+    backup_md5 text
+) without rowid;
+'''
+
+
+class PathIndex:
+    '''on disk path -> (pkg, version, state digest) lookups, so point queries don't need pacman or the state'''
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        mkdir_p(self.db_path.parent)
+        self.db = sqlite3.connect(str(self.db_path))
+        if self.db.execute('pragma user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.db.executescript('drop table if exists meta; drop table if exists files; pragma user_version = %s;' % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+
+    @property
+    def generation(self):
+        r = self.db.execute('select value from meta where key = ?', ('generation',)).fetchone()
+        return r[0] if r else None
+
+    def rebuild(self, index, generation):
+        '''replace the contents with everything a FileIndex knows'''
+        rows = {}
+        for f, (pkg, version) in index.owners.items():
+            rows[f] = [pkg, version, None, None]
+        for f, (pkg, version) in index.config_owners.items():
+            rows[f] = [pkg, version, None, index.backup_md5[f]]
+        for f, (pkg, version) in index.state_owners.items():
+            row = rows.setdefault(f, [pkg, version, None, None])
+            row[0], row[1] = pkg, version
+            row[2] = bytes.fromhex(index.state[pkg][version][f])
+        with self.db:
+            self.db.execute('delete from files')
+            self.db.executemany('insert into files values (?, ?, ?, ?, ?)', ((f, *row) for f, row in rows.items()))
+            self.db.execute('insert or replace into meta values (?, ?)', ('generation', generation))
+
+    def lookup(self, path):
+        # (pkg, version, digest, backup md5) or None
+        return self.db.execute('select pkg, version, digest, backup_md5 from files where path = ?', (path,)).fetchone()
+
+    def classify(self, p, ignored_paths, file_digests):
+        '''same classification as FileIndex.classify, file_digests(path, algorithms) as HashCache.digests'''
+        p = Path(p)
+        presolved = p.resolve()
+        if startswith_any(str(p), ignored_paths) or startswith_any(str(presolved), ignored_paths):
+            return Classified(str(p), IGNORED_FILE, None, None, None, None)
+        s = str(presolved)
+        if not presolved.is_file():
+            return Classified(s, MISSING_FILE, None, None, None, None)
+
+        r = self.lookup(s)
+        if r is None:
+            return Classified(s, ORPHAN_FILE, None, None, None, None)
+        pkg, version, digest, md5 = r
+        # the file is read once for both digests
+        algorithms = ([SHA256] if digest is not None else []) + ([MD5] if md5 is not None else [])
+        if digest is not None:
+            expected = digest.hex()
+            actual = file_digests(s, algorithms)[SHA256]
+            cls = UNMODIFIED_FILE if actual == expected else MODIFIED_FILE
+            return Classified(s, cls, pkg, version, expected, actual)
+        if md5 is not None and backup_status(md5, lambda: file_digests(s, algorithms)[MD5]) == UNMODIFIED:
+            return Classified(s, UNMODIFIED_FILE, pkg, version, None, None)
+        return Classified(s, UNCHECKABLE_FILE, pkg, version, None, None)
+
+    def close(self):
+        self.db.close()
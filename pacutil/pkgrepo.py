@@ -0,0 +1,107 @@
+import os
+
+from pathlib import Path
+
+from . import logging as log
+from .util import get_cache_path, get_hash, mkdir_p
+from hg import hg as _hg, split_lines
+
+
+TAG_SEP = '#'
+BASE_TAG_NAME = '0'
+
+
+class PkgRepoException(Exception):
+    pass
+
+
+def tag_escape(tag):
+    return tag.replace(':', '_')
+
+def tag_name(branch, version=None):
+    if version is None:
+        version = BASE_TAG_NAME
+    s = branch + TAG_SEP + version
+    return tag_escape(s)
+
+def tag_split(tag):
+    return tag.split(TAG_SEP, 1)
+
+
+class PkgRepo(_hg):
+    '''the repository packages are staged in, one branch per package'''
+    def __init__(self, *args):
+        _hg.__init__(self, *args, log=log)
+
+    def branch_manifests(self):
+        '''branch -> tracked paths of its newest head, for all branches with a single hg call'''
+        # self.log is the logger, hg log has to be named
+        out = self.make_command('log')(r='head() and not closed()', T='{branch}\\0{join(files("**"), "\\0")}\\n')
+        r = {}
+        # heads come in revision order, the newest one of a branch wins
+        for line in split_lines(out):
+            branch, *fs = line.split('\0')
+            r[branch] = set(f for f in fs if f)
+        return r
+
+    def files_differ(self, fs, tracked=None):
+        '''tracked: paths tracked in the working copy's revision, e.g. from branch_manifests, the working copy's status otherwise'''
+        if tracked is None:
+            tracked = set(self.repo_files())
+
+        #check if all files are present
+        differs = False
+        for f in fs:
+            fp = Path(f)
+            assert(fp.is_absolute())
+            rel = str(fp.relative_to('/'))
+            if rel not in tracked:
+                differs = True
+                log.info('%s differs from %s' % (Path(self.repo_path) / rel, f))
+
+        #check if files were removed
+        for rel in tracked:
+            if rel.startswith('.hg'):
+                continue
+            f = Path('/') / rel
+            if not os.path.lexists(str(f)):
+                differs = True
+                log.info('%s differs from %s' % (Path(self.repo_path) / rel, f))
+        return differs
+
+
+def share_working_copies(repo, n, base=None):
+    '''n working copies sharing repo's store, kept below base, the cache by default, and reused across runs'''
+    if base is None:
+        base = get_cache_path() / 'shares' / get_hash(str(repo.repo_path).encode('utf-8'))[:16]
+    for i in range(n):
+        d = base / str(i)
+        if not _hg.is_repo_internal_dir(d / '.hg'):
+            mkdir_p(base)
+            repo.share(repo.repo_path, d, noupdate=True, config='extensions.share=')
+        share = PkgRepo(str(d))
+        # local tags are per working copy, tags still here were left by a run that crashed before collecting them
+        if (d / '.hg' / 'localtags').exists():
+            log.warning('collecting tags left in %s by an earlier run' % d)
+            collect_share_tags(repo, [share])
+        yield share
+
+
+def collect_share_tags(repo, shares):
+    '''move the local tags set in shares into repo and check they point to commits on their branch'''
+    inconsistent = []
+    for share in shares:
+        localtags = Path(share.repo_path) / '.hg' / 'localtags'
+        if not localtags.exists():
+            continue
+        for line in split_lines(localtags.read_text()):
+            node, tag = line.split(' ', 1)
+            branch, _ = tag_split(tag)
+            actual = repo.make_command('log')(r=node, T='{branch}')
+            if actual != branch:
+                inconsistent.append('%s: %s is on branch %s' % (tag, node, actual))
+                continue
+            repo.tag(tag, local=True, force=True, r=node)
+        localtags.unlink()
+    if inconsistent:
+        raise PkgRepoException('inconsistent tags after staging:\n%s' % '\n'.join(inconsistent))
@@ -0,0 +1,226 @@
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+from pathlib import Path
+
+from . import logging as log
+from .util import mkdir_p, hostname
+
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+# heartbeats/<claim file name>, a counter the claiming worker keeps increasing
+HEARTBEATS = 'heartbeats'
+# claimed/<job name><CLAIM_SEP><worker id>
+CLAIM_SEP = '#'
+
+HEARTBEAT_INTERVAL = 30
+# claims whose heartbeat counter did not change for this long belong to a crashed worker
+STALE_AFTER = 600
+
+
+def worker_id():
+    return '%s:%s' % (hostname, os.getpid())
+
+
+def job_name(pkg, version):
+    return '%s %s' % (urllib.parse.quote(pkg, safe=''), urllib.parse.quote(version, safe=''))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Claim:
+    def __init__(self, spool, name, path):
+        self.spool = spool
+        self.name = name
+        self.path = path
+        self.beats = 0
+        with path.open('r') as f:
+            self.job = json.load(f)
+
+
+class Spool:
+    '''a job queue in a directory shared by workers on one or more hosts
+
+    Every state change of a job is a rename, which is atomic even on NFS, so exactly one worker
+    wins each claim. Workers count up a heartbeat of their claims regularly, claims whose heartbeat
+    stops changing are put back by whichever worker notices first. Changes are timed with each
+    worker's own monotonic clock, so clocks of different hosts don't have to agree.'''
+    def __init__(self, path, stale_after=STALE_AFTER):
+        self.path = Path(path)
+        self.stale_after = stale_after
+        # claim file name -> (last heartbeat seen, when it was first seen)
+        self.seen = {}
+        for d in (PENDING, CLAIMED, DONE, FAILED, HEARTBEATS):
+            mkdir_p(self.path / d)
+
+    def _exists(self, name):
+        if any((self.path / d / name).exists() for d in (PENDING, DONE, FAILED)):
+            return True
+        return any(n.startswith(name + CLAIM_SEP) for n in os.listdir(str(self.path / CLAIMED)))
+
+    def enqueue(self, pkg, version, job):
+        '''False if the job is queued, running or finished already'''
+        name = job_name(pkg, version)
+        if self._exists(name):
+            return False
+        tmp = self.path / ('.%s.%s' % (name, worker_id()))
+        with tmp.open('w') as f:
+            json.dump(dict(job, pkg=pkg, version=version), f)
+        os.replace(str(tmp), str(self.path / PENDING / name))
+        return True
+
+    def claim(self):
+        names = os.listdir(str(self.path / PENDING))
+        # spread workers over the queue instead of all racing for the first job
+        random.shuffle(names)
+        for name in names:
+            dst = self.path / CLAIMED / (name + CLAIM_SEP + worker_id())
+            try:
+                os.rename(str(self.path / PENDING / name), str(dst))
+            except FileNotFoundError:
+                continue
+            claim = Claim(self, name, dst)
+            self.heartbeat(claim)
+            return claim
+        return None
+
+    def _heartbeat_path(self, claim_file):
+        return self.path / HEARTBEATS / claim_file
+
+    def _read_heartbeat(self, claim_file):
+        try:
+            return self._heartbeat_path(claim_file).read_text()
+        except FileNotFoundError:
+            return None
+
+    def heartbeat(self, claim):
+        '''renew the claim, raises FileNotFoundError if it has been taken away'''
+        os.stat(str(claim.path))
+        f = self._heartbeat_path(claim.path.name)
+        tmp = f.with_name('.%s' % f.name)
+        tmp.write_text(str(claim.beats))
+        os.replace(str(tmp), str(f))
+        claim.beats += 1
+
+    def _remove_heartbeat(self, claim_file):
+        try:
+            self._heartbeat_path(claim_file).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _finish(self, claim, d, result):
+        with claim.path.open('w') as f:
+            json.dump(dict(claim.job, result=result, worker=worker_id(), finished=time.time()), f)
+        os.replace(str(claim.path), str(self.path / d / claim.name))
+        self._remove_heartbeat(claim.path.name)
+
+    def complete(self, claim, result=None):
+        self._finish(claim, DONE, result)
+
+    def fail(self, claim, error):
+        self._finish(claim, FAILED, dict(error=str(error)))
+
+    def recover_stale(self):
+        '''put claims of crashed workers back into the queue
+
+        A claim of another host only counts as stale once this worker has seen its heartbeat
+        unchanged for stale_after seconds.'''
+        recovered = []
+        now = time.monotonic()
+        # listed first, claims made in between must not make their heartbeats look left over
+        heartbeats = os.listdir(str(self.path / HEARTBEATS))
+        claims = os.listdir(str(self.path / CLAIMED))
+        self.seen = {n: v for n, v in self.seen.items() if n in claims}
+        # left behind when a worker renewed its claim while it was being recovered
+        for n in set(heartbeats) - set(claims):
+            if not n.startswith('.'):
+                self._remove_heartbeat(n)
+        for n in claims:
+            name, _, owner = n.rpartition(CLAIM_SEP)
+            host, _, pid = owner.rpartition(':')
+            # dead workers on this host are noticed right away, others by their heartbeat
+            dead = host == hostname and pid.isdigit() and not _pid_alive(int(pid))
+            beat = self._read_heartbeat(n)
+            last = self.seen.get(n)
+            if last is None or last[0] != beat:
+                self.seen[n] = (beat, now)
+                if not dead:
+                    continue
+            elif not dead and now - last[1] < self.stale_after:
+                continue
+            try:
+                os.rename(str(self.path / CLAIMED / n), str(self.path / PENDING / name))
+            except FileNotFoundError:
+                continue
+            self._remove_heartbeat(n)
+            del self.seen[n]
+            log.warning('recovered %s from %s' % (name, owner))
+            recovered.append(name)
+        return recovered
+
+    def counts(self):
+        return {d: len(os.listdir(str(self.path / d))) for d in (PENDING, CLAIMED, DONE, FAILED)}
+
+
+class Heartbeat:
+    '''touches a claim in the background while its job runs'''
+    def __init__(self, claim, interval=HEARTBEAT_INTERVAL):
+        self.claim = claim
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.claim.spool.heartbeat(self.claim)
+            except FileNotFoundError:
+                log.warning('lost claim on %s' % self.claim.name)
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def work(spool, run_job, wait=False, poll_interval=5, heartbeat_interval=HEARTBEAT_INTERVAL):
+    '''claim and run jobs until the queue is empty, or forever with wait; returns (done, failed)'''
+    done = failed = 0
+    while True:
+        spool.recover_stale()
+        claim = spool.claim()
+        if claim is None:
+            if not wait:
+                return done, failed
+            time.sleep(poll_interval)
+            continue
+        log.message('%s: %s %s' % (worker_id(), claim.job['pkg'], claim.job['version']))
+        try:
+            with Heartbeat(claim, heartbeat_interval):
+                result = run_job(claim.job)
+        except Exception as e:
+            log.error('%s %s failed: %s' % (claim.job['pkg'], claim.job['version'], e))
+            spool.fail(claim, e)
+            failed += 1
+        else:
+            spool.complete(claim, result)
+            done += 1
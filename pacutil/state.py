@@ -0,0 +1,353 @@
+import fcntl
+import json
+import struct
+
+from collections import OrderedDict as odict
+from collections.abc import MutableMapping
+from pathlib import Path
+
+from .util import mkdir_p, write_atomic
+
+
+STATE_EXT = '.pstate'
+LEGACY_STATE_EXT = '.json'
+INSTALLED_DIR = 'installed'
+LOCK_DIR = '.locks'
+
+MAGIC = b'PCST'
+FORMAT_VERSION = 1
+DIGEST_SIZE = 32
+NO_BASE = 0xffffffff
+# store a full version every so often so that materializing never walks the whole history
+KEYFRAME_EVERY = 16
+
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_entry = struct.Struct('<I%ss' % DIGEST_SIZE)
+
+
+def _encode(s):
+    return s.encode('utf-8', 'surrogateescape')
+
+
+def _decode(b):
+    return b.decode('utf-8', 'surrogateescape')
+
+
+class StateFormatException(Exception):
+    pass
+
+
+class PathTable:
+    # prefix table: every path component is a node (parent, name), node 0 is '/'
+    def __init__(self):
+        self.nodes = [(0, '')]
+        self.index = {}
+        self.strs = ['']
+
+    def intern(self, path):
+        assert(path.startswith('/'))
+        node = 0
+        for name in path.split('/')[1:]:
+            key = (node, name)
+            n = self.index.get(key)
+            if n is None:
+                n = len(self.nodes)
+                self.nodes.append(key)
+                self.index[key] = n
+                self.strs.append(self.strs[node] + '/' + name)
+            node = n
+        return node
+
+    def path(self, node):
+        return self.strs[node]
+
+    def add_node(self, parent, name):
+        n = len(self.nodes)
+        self.nodes.append((parent, name))
+        self.index[(parent, name)] = n
+        self.strs.append(self.strs[parent] + '/' + name)
+        return n
+
+
+class PkgState(MutableMapping):
+    '''version -> {path: hexdigest} of a single package
+
+    Versions are kept in the order they were added, each stored as a delta against its
+    predecessor with interned paths and binary digests. Accessing a version materializes
+    it once, later lookups are plain dict lookups.'''
+    def __init__(self, versions=None):
+        self.paths = PathTable()
+        # version -> (base version or None, {node: digest}, [removed nodes])
+        self.deltas = odict()
+        self._nodes_cache = {}
+        self._files_cache = {}
+        if versions:
+            for version, files in versions.items():
+                self[version] = files
+
+    def _chain_length(self, version):
+        n = 0
+        while version is not None:
+            n += 1
+            version = self.deltas[version][0]
+        return n
+
+    def _nodes(self, version):
+        r = self._nodes_cache.get(version)
+        if r is not None:
+            return r
+        chain = []
+        v = version
+        while v is not None and v not in self._nodes_cache:
+            chain.append(v)
+            v = self.deltas[v][0]
+        r = dict(self._nodes_cache[v]) if v is not None else {}
+        for v in reversed(chain):
+            base, added, removed = self.deltas[v]
+            for n in removed:
+                del r[n]
+            r.update(added)
+        self._nodes_cache[version] = r
+        return r
+
+    def digests(self, version):
+        '''{path node: binary digest} of version, as stored, nodes are those of self.paths'''
+        if version not in self.deltas:
+            raise KeyError(version)
+        return self._nodes(version)
+
+    def __getitem__(self, version):
+        r = self._files_cache.get(version)
+        if r is None:
+            if version not in self.deltas:
+                raise KeyError(version)
+            path = self.paths.path
+            r = {path(n): d.hex() for n, d in self._nodes(version).items()}
+            self._files_cache[version] = r
+        return r
+
+    def __contains__(self, version):
+        return version in self.deltas
+
+    def __iter__(self):
+        return iter(self.deltas)
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def _invalidate(self):
+        self._nodes_cache = {}
+        self._files_cache = {}
+
+    def _to_nodes(self, files):
+        r = {}
+        for f, h in files.items():
+            d = bytes.fromhex(h) if isinstance(h, str) else bytes(h)
+            if len(d) != DIGEST_SIZE:
+                raise StateFormatException('invalid digest for %s: %s' % (f, h))
+            r[self.paths.intern(f)] = d
+        return r
+
+    def _append(self, version, nodes):
+        base = next(reversed(self.deltas), None)
+        if base is None or self._chain_length(base) >= KEYFRAME_EVERY:
+            self.deltas[version] = (None, nodes, [])
+        else:
+            prev = self._nodes(base)
+            added = {n: d for n, d in nodes.items() if prev.get(n) != d}
+            removed = [n for n in prev if n not in nodes]
+            self.deltas[version] = (base, added, removed)
+        self._nodes_cache[version] = nodes
+
+    def _rebuild(self, versions):
+        # versions: version -> {node: digest}, re-encode the whole chain
+        self.deltas = odict()
+        self._invalidate()
+        for version, nodes in versions.items():
+            self._append(version, nodes)
+
+    def __setitem__(self, version, files):
+        nodes = self._to_nodes(files)
+        if version not in self.deltas:
+            self._append(version, nodes)
+            return
+        versions = odict((v, nodes if v == version else self._nodes(v)) for v in self.deltas)
+        self._rebuild(versions)
+
+    def __delitem__(self, version):
+        self.drop([version])
+
+    def drop(self, versions):
+        '''delete all of versions, re-encoding the chain only once'''
+        versions = set(versions)
+        for version in versions:
+            if version not in self.deltas:
+                raise KeyError(version)
+        self._rebuild(odict((v, self._nodes(v)) for v in self.deltas if v not in versions))
+
+    def compact(self):
+        # drop path nodes no longer referenced by any version
+        versions = odict((v, self[v]) for v in self.deltas)
+        self.paths = PathTable()
+        self._rebuild(odict((v, self._to_nodes(fs)) for v, fs in versions.items()))
+
+    def to_bytes(self):
+        b = [MAGIC, _u32.pack(FORMAT_VERSION), _u32.pack(len(self.paths.nodes) - 1)]
+        for parent, name in self.paths.nodes[1:]:
+            name = _encode(name)
+            b += [_u32.pack(parent), _u16.pack(len(name)), name]
+
+        index = {v: i for i, v in enumerate(self.deltas)}
+        b.append(_u32.pack(len(self.deltas)))
+        for version, (base, added, removed) in self.deltas.items():
+            v = _encode(version)
+            b += [_u16.pack(len(v)), v, _u32.pack(NO_BASE if base is None else index[base])]
+            b.append(_u32.pack(len(added)))
+            b += [_entry.pack(n, d) for n, d in added.items()]
+            b.append(_u32.pack(len(removed)))
+            b.append(struct.pack('<%sI' % len(removed), *removed))
+        return b''.join(b)
+
+    @classmethod
+    def from_bytes(cls, b):
+        if b[:len(MAGIC)] != MAGIC:
+            raise StateFormatException('not a state file')
+        try:
+            return cls._from_bytes(b)
+        except (struct.error, IndexError) as e:
+            # truncated, or references to nodes or versions that are not there
+            raise StateFormatException('corrupt state file: %s' % e)
+
+    @classmethod
+    def _from_bytes(cls, b):
+        o = len(MAGIC)
+
+        def read(s):
+            nonlocal o
+            r = s.unpack_from(b, o)
+            o += s.size
+            return r[0] if len(r) == 1 else r
+
+        def read_str():
+            nonlocal o
+            n = read(_u16)
+            if o + n > len(b):
+                raise StateFormatException('truncated state file')
+            r = _decode(b[o:o + n])
+            o += n
+            return r
+
+        fmt = read(_u32)
+        if fmt != FORMAT_VERSION:
+            raise StateFormatException('unsupported state format %s' % fmt)
+        r = cls()
+        for _ in range(read(_u32)):
+            parent = read(_u32)
+            r.paths.add_node(parent, read_str())
+
+        versions = []
+        for _ in range(read(_u32)):
+            version = read_str()
+            base = read(_u32)
+            base = None if base == NO_BASE else versions[base]
+            added = {}
+            for _ in range(read(_u32)):
+                n, d = read(_entry)
+                if n >= len(r.paths.nodes):
+                    raise StateFormatException('corrupt state file: unknown node %s' % n)
+                added[n] = d
+            nremoved = read(_u32)
+            removed = list(struct.unpack_from('<%sI' % nremoved, b, o))
+            o += 4 * nremoved
+            r.deltas[version] = (base, added, removed)
+            versions.append(version)
+        return r
+
+
+def load_pkg_state(pkgf):
+    pkgf = Path(pkgf)
+    if pkgf.suffix == STATE_EXT:
+        return PkgState.from_bytes(pkgf.read_bytes())
+    with pkgf.open('r') as f:
+        return PkgState(json.load(f, object_pairs_hook=odict))
+
+
+def load_state(state_path):
+    state = odict()
+    if state_path.exists():
+        for pkgf in state_path.glob('*' + STATE_EXT):
+            state[pkgf.stem] = load_pkg_state(pkgf)
+        # not yet converted
+        for pkgf in state_path.glob('*' + LEGACY_STATE_EXT):
+            if pkgf.stem not in state:
+                state[pkgf.stem] = load_pkg_state(pkgf)
+    return state
+
+
+def save_state(state, state_path):
+    mkdir_p(state_path)
+    for pkg, pkg_state in state.items():
+        if not isinstance(pkg_state, PkgState):
+            pkg_state = PkgState(pkg_state)
+        pkgf = state_path / (pkg + STATE_EXT)
+        legacy_pkgf = state_path / (pkg + LEGACY_STATE_EXT)
+        if not pkg_state:
+            for f in (pkgf, legacy_pkgf):
+                if f.exists():
+                    f.unlink()
+            continue
+        write_atomic(pkgf, pkg_state.to_bytes())
+        if legacy_pkgf.exists():
+            legacy_pkgf.unlink()
+
+
+def update_pkg_state(state_path, pkg, version, files):
+    '''add a version to the stored state of pkg, safe against other processes doing the same'''
+    mkdir_p(state_path / LOCK_DIR)
+    with (state_path / LOCK_DIR / (pkg + '.lock')).open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        pkg_state = PkgState()
+        for ext in (STATE_EXT, LEGACY_STATE_EXT):
+            pkgf = state_path / (pkg + ext)
+            if pkgf.exists():
+                pkg_state = load_pkg_state(pkgf)
+                break
+        pkg_state[version] = files
+        save_state({pkg: pkg_state}, state_path)
+    return pkg_state
+
+
+def compact_state(state):
+    for pkg_state in state.values():
+        pkg_state.compact()
+
+
+def record_installed(state_path, machine, installed_pkgs):
+    # remember which versions this machine has installed, used by gc_state
+    d = state_path / INSTALLED_DIR
+    mkdir_p(d)
+    with (d / (machine + '.json')).open('w') as f:
+        json.dump(installed_pkgs, f, indent=2)
+
+
+def installed_versions(state_path):
+    r = {}
+    d = state_path / INSTALLED_DIR
+    if d.exists():
+        for f in d.glob('*.json'):
+            with f.open('r') as fh:
+                for pkg, version in json.load(fh).items():
+                    r.setdefault(pkg, set()).add(version)
+    return r
+
+
+def gc_state(state, keep):
+    # keep: pkg -> versions that are still installed somewhere
+    dropped = []
+    for pkg, pkg_state in state.items():
+        versions = [version for version in pkg_state if version not in keep.get(pkg, ())]
+        if versions:
+            pkg_state.drop(versions)
+            dropped += [(pkg, version) for version in versions]
+    return dropped
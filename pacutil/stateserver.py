@@ -0,0 +1,286 @@
+import hashlib
+import hmac
+import ipaddress
+import json
+import re
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from . import logging as log
+from .util import mkdir_p, write_atomic
+
+
+DEFAULT_PORT = 8731
+TOKEN_ENV = 'PACUTIL_STATE_TOKEN'
+# (pkg, version) pairs per batch request
+BATCH_SIZE = 200
+TIMEOUT = 30
+
+
+class StateServerException(Exception):
+    pass
+
+
+_digest_re = re.compile(r'[0-9a-f]{64}')
+
+
+def _quote(s):
+    return urllib.parse.quote(s, safe='')
+
+
+def _segment(s):
+    # quote leaves these as they are, they would leave the store
+    if s in ('', '.', '..'):
+        raise StateServerException('invalid path segment %r' % s)
+    return _quote(s)
+
+
+def valid_entry(files):
+    return isinstance(files, dict) and all(isinstance(f, str) and f.startswith('/') and isinstance(h, str) and _digest_re.fullmatch(h)
+                                           for f, h in files.items())
+
+
+def entry_etag(data):
+    return '"%s"' % hashlib.sha256(data).hexdigest()
+
+
+def _entry_path(root, arch, pkg, version):
+    # entries are immutable, one file per (arch, pkg, version)
+    root = Path(root)
+    f = root / _segment(arch) / _segment(pkg) / (_segment(version) + '.json')
+    if os.path.commonpath([str(root.resolve()), str(f.resolve())]) != str(root.resolve()):
+        raise StateServerException('%s is outside of %s' % (f, root))
+    return f
+
+
+class StateStore:
+    '''the server side: state entries as json files below root'''
+    def __init__(self, root):
+        self.root = Path(root)
+        # uploads run in the server's threads, checking for an entry and writing it must not interleave
+        self.lock = threading.Lock()
+
+    def get(self, arch, pkg, version):
+        f = _entry_path(self.root, arch, pkg, version)
+        return f.read_bytes() if f.exists() else None
+
+    def put(self, arch, pkg, version, data):
+        '''False if a different entry is stored already, the first upload wins'''
+        files = json.loads(data.decode('utf-8'))
+        if not valid_entry(files):
+            raise StateServerException('invalid state entry for %s %s' % (pkg, version))
+        # normalize so equal entries get equal etags whichever host uploaded them
+        data = json.dumps(files, sort_keys=True).encode('utf-8')
+        f = _entry_path(self.root, arch, pkg, version)
+        with self.lock:
+            old = self.get(arch, pkg, version)
+            if old is not None:
+                return old == data
+            mkdir_p(f.parent)
+            write_atomic(f, data)
+        return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    # /state/<arch>/<pkg>/<version>  GET with If-None-Match, PUT to upload
+    # /batch/<arch>                  POST {"entries": [[pkg, version, etag or null], ...]}
+    # with a token every request needs an 'Authorization: Bearer <token>' header
+    store = None
+    token = None
+
+    def log_message(self, fmt, *args):
+        log.debug('%s %s' % (self.address_string(), fmt % args))
+
+    def _parts(self):
+        return [urllib.parse.unquote(p) for p in urllib.parse.urlsplit(self.path).path.split('/')[1:]]
+
+    def _send(self, code, data=b'', headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def _send_json(self, code, obj):
+        self._send(code, json.dumps(obj).encode('utf-8'), [('Content-Type', 'application/json')])
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _authorized(self):
+        if self.token is None:
+            return True
+        if hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer %s' % self.token):
+            return True
+        self._send(401, headers=[('WWW-Authenticate', 'Bearer')])
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        parts = self._parts()
+        if len(parts) != 4 or parts[0] != 'state':
+            return self._send(404)
+        try:
+            data = self.store.get(*parts[1:])
+        except StateServerException as e:
+            return self._send_json(400, dict(error=str(e)))
+        if data is None:
+            return self._send(404)
+        etag = entry_etag(data)
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, headers=[('ETag', etag)])
+        self._send(200, data, [('Content-Type', 'application/json'), ('ETag', etag)])
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        parts = self._parts()
+        if len(parts) != 4 or parts[0] != 'state':
+            return self._send(404)
+        try:
+            stored = self.store.put(*parts[1:], self._body())
+        except (ValueError, StateServerException) as e:
+            return self._send_json(400, dict(error=str(e)))
+        self._send(204 if stored else 409)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        parts = self._parts()
+        if len(parts) != 2 or parts[0] != 'batch':
+            return self._send(404)
+        arch = parts[1]
+        try:
+            entries = json.loads(self._body().decode('utf-8'))['entries']
+            r = []
+            for pkg, version, etag in entries:
+                data = self.store.get(arch, pkg, version)
+                if data is None:
+                    r.append([pkg, version, 'missing', None, None])
+                elif entry_etag(data) == etag:
+                    r.append([pkg, version, 'not-modified', etag, None])
+                else:
+                    r.append([pkg, version, 'ok', entry_etag(data), json.loads(data.decode('utf-8'))])
+        except (ValueError, KeyError, StateServerException) as e:
+            return self._send_json(400, dict(error=str(e)))
+        self._send_json(200, dict(entries=r))
+
+
+def _loopback(bind):
+    try:
+        return ipaddress.ip_address(bind).is_loopback
+    except ValueError:
+        return bind == 'localhost'
+
+
+def make_server(root, bind='127.0.0.1', port=DEFAULT_PORT, token=None):
+    '''a server for the state below root, not serving yet, port 0 picks a free port
+
+    Whoever may upload can make modified files look unmodified on every host that fetches the state,
+    so serving beyond localhost needs a token shared by the trusted hosts only.'''
+    if token is None and not _loopback(bind):
+        raise StateServerException('refusing to serve on %s without a token, set %s or state_server_token' % (bind, TOKEN_ENV))
+    handler = type('StateHandler', (Handler,), dict(store=StateStore(root), token=token))
+    return ThreadingHTTPServer((bind, port), handler)
+
+
+def serve(root, bind='127.0.0.1', port=DEFAULT_PORT, token=None):
+    '''serve the state below root until interrupted, see make_server'''
+    server = make_server(root, bind, port, token)
+    log.message('serving state from %s on http://%s:%s' % (root, bind, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class StateClient:
+    '''fetches state entries computed by other hosts and uploads our own, with a local cache
+
+    The cache keeps each entry with its etag, so entries already known are only revalidated,
+    and are used as they are when the server can't be reached. Fetched entries are trusted like
+    our own state, the server and everyone holding its token have to be trusted as much.'''
+    def __init__(self, base_url, cache_path, arch, batch_size=BATCH_SIZE, token=None):
+        self.base_url = base_url.rstrip('/')
+        self.cache_path = Path(cache_path)
+        self.arch = arch
+        self.batch_size = batch_size
+        self.token = token
+
+    def _cached(self, pkg, version):
+        f = _entry_path(self.cache_path, self.arch, pkg, version)
+        if not f.exists():
+            return None, None
+        with f.open('r') as fh:
+            e = json.load(fh)
+        return e['etag'], e['files']
+
+    def _cache(self, pkg, version, etag, files):
+        data = json.dumps(dict(etag=etag, files=files)).encode('utf-8')
+        f = _entry_path(self.cache_path, self.arch, pkg, version)
+        mkdir_p(f.parent)
+        write_atomic(f, data)
+
+    def _request(self, method, url, data=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.token is not None:
+            headers['Authorization'] = 'Bearer %s' % self.token
+        req = urllib.request.Request(url, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def fetch(self, wanted):
+        '''{(pkg, version): {path: hexdigest}} of those (pkg, version) pairs any host has computed'''
+        wanted = list(wanted)
+        cached = {pv: self._cached(*pv) for pv in wanted}
+        r = {}
+        for i in range(0, len(wanted), self.batch_size):
+            batch = wanted[i:i + self.batch_size]
+            body = json.dumps(dict(entries=[[pkg, version, cached[(pkg, version)][0]] for pkg, version in batch]))
+            try:
+                code, data = self._request('POST', '%s/batch/%s' % (self.base_url, _quote(self.arch)), body.encode('utf-8'))
+                if code != 200:
+                    raise StateServerException('%s: HTTP %s' % (self.base_url, code))
+            except (OSError, StateServerException) as e:
+                log.warning('state server unavailable, using cached entries: %s' % e)
+                r.update((pv, files) for pv, (etag, files) in cached.items() if files is not None)
+                return r
+            for pkg, version, status, etag, files in json.loads(data.decode('utf-8'))['entries']:
+                if (pkg, version) not in cached:
+                    continue
+                if status == 'ok':
+                    if not valid_entry(files):
+                        log.warning('ignoring invalid state of %s %s from %s' % (pkg, version, self.base_url))
+                        continue
+                    self._cache(pkg, version, etag, files)
+                    r[(pkg, version)] = files
+                elif status == 'not-modified':
+                    r[(pkg, version)] = cached[(pkg, version)][1]
+        return r
+
+    def upload(self, pkg, version, files):
+        url = '%s/state/%s/%s/%s' % (self.base_url, _quote(self.arch), _quote(pkg), _quote(version))
+        try:
+            code, data = self._request('PUT', url, json.dumps(files, sort_keys=True).encode('utf-8'))
+        except OSError as e:
+            log.warning('cannot upload state of %s %s: %s' % (pkg, version, e))
+            return False
+        if code == 409:
+            log.warning('state server has a different state for %s %s' % (pkg, version))
+        elif code >= 300:
+            log.warning('cannot upload state of %s %s: HTTP %s %s' % (pkg, version, code, data.decode('utf-8', 'replace')))
+        return code < 300
@@ -1,4 +1,6 @@
+import contextlib
 import tempfile
+import os
 
 from pathlib import Path
 
@@ -8,6 +10,9 @@ import hashlib
 import socket
 
 from . import logging as log
+from . import fastcopy
+from . import ioorder
+from . import governor as _governor
 
 
 import re
@@ -15,13 +20,46 @@ import re
 
 hostname = socket.gethostname()
 
+# files written through atomic_open get the permissions open() would give them
+_umask = os.umask(0)
+os.umask(_umask)
+
 def temp_dir(prefix):
     path = tempfile.mkdtemp(prefix=prefix)
     return Path(path)
 
 
+def get_cache_path():
+    base = os.getenv('XDG_CACHE_HOME')
+    base = Path(base) if base else Path.home() / '.cache'
+    return base / 'pacutil'
+
+
 def mkdir_p(p):
     return p.mkdir(exist_ok=True, parents=True)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='wb'):
+    '''a file that replaces path when the block completes, readers never see it partially written
+
+    The temporary file has a unique name, so threads and processes can write the same path concurrently, the last one wins.'''
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % path.name, dir=str(path.parent))
+    try:
+        os.fchmod(fd, 0o666 & ~_umask)
+        with open(fd, mode) as f:
+            yield f
+        os.replace(tmp, str(path))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_atomic(path, data):
+    with atomic_open(path) as f:
+        f.write(data)
+
     
 def check_output(cmd, *args, **kwargs):
     log.debug(' '.join(cmd))
@@ -32,19 +70,106 @@ def check_call(cmd, *args, **kwargs):
     return subprocess.check_call(cmd, *args, **kwargs)
 
 def copy_archive(fa, fb, sudo=False):
-    cmd = ['cp', '-a', str(fa), str(fb)]
-    if sudo:
-        cmd = ['sudo'] + cmd
-    return check_call(cmd)
-    
+    return copy_archive_batch([(fa, fb)], sudo=sudo)
 
-def file_hash(filename):
-    h = hashlib.sha256()
-    BUF_SIZE = 128*1024
+
+def copy_archive_batch(pairs, sudo=False):
+    # in process and in parallel, with sudo one privileged process per batch
+    pairs = [(str(fa), str(fb)) for fa, fb in pairs]
+    log.debug('copying %s files' % len(pairs))
+    if sudo:
+        return fastcopy.copy_batch_sudo(pairs)
+    return fastcopy.copy_batch(pairs)
+
+
+def file_hashes_sudo(filenames, algorithm='sha256'):
+    # digests of files we may not read ourselves, in one privileged call of coreutils' md5sum, sha256sum, ...
+    r = {}
+    filenames = [str(f) for f in filenames]
+    if filenames:
+        out = check_output(['sudo', '%ssum' % algorithm, '--'] + filenames, universal_newlines=True)
+        for line in out.split('\n'):
+            if line:
+                h, f = line.split(' ', 1)
+                r[f[1:]] = h
+    return r
+
+
+def file_types_sudo(filenames):
+    '''path -> find's %y type letter of those filenames that exist, for paths in directories we may not search ourselves'''
+    filenames = [str(f) for f in filenames]
+    if not filenames:
+        return {}
+    # / always exists, without it in the output sudo itself failed rather than the files missing
+    cmd = ['sudo', 'find', '/'] + filenames + ['-maxdepth', '0', '-printf', '%y %p\\0']
+    log.debug(' '.join(cmd))
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    entries = [e.split(' ', 1) for e in out.split('\0') if e]
+    if not entries or entries[0] != ['d', '/']:
+        raise subprocess.CalledProcessError(1, cmd)
+    return {f: t for t, f in entries[1:]}
+
+
+# files up to this size are read ahead completely as soon as they are opened
+WILLNEED_MAX = 16*1024*1024
+BUF_SIZE = 256*1024
+
+def _read_digests(f, algorithms, size=None, governor=None):
+    # hash everything read from f, size is only known for regular files
+    hs = [hashlib.new(a) for a in algorithms]
+    buf = bytearray(BUF_SIZE)
+    view = memoryview(buf)
+    left = size
+    while True:
+        if governor is not None and (left is None or left > 0):
+            governor.read(BUF_SIZE if left is None else min(BUF_SIZE, left))
+        n = f.readinto(buf)
+        if not n:
+            break
+        if left is not None:
+            left -= n
+        for h in hs:
+            h.update(view[:n])
+    return {a: h.hexdigest() for a, h in zip(algorithms, hs)}
+
+def file_digests(filename, algorithms=('sha256',), drop_cache=False):
+    '''{algorithm: hexdigest} of all requested hashlib algorithms from a single read of the file
+
+    drop_cache evicts the file's pages after hashing, unless some of it was already cached before.
+    Reads are paced by the installed governor, if any.'''
+    governor = _governor.current()
+    if governor is not None and not governor.limits_reads:
+        # only pausing on load, the file can be read at full speed once the host isn't busy
+        governor.backoff()
+        governor = None
     with open(filename, 'rb', buffering=0) as f:
-        for b in iter(lambda : f.read(BUF_SIZE), b''):
-            h.update(b)
-    return h.hexdigest()
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        was_cached = drop_cache and ioorder.resident(fd, size)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # read ahead would get around the governor's bandwidth limit
+        if size <= WILLNEED_MAX and governor is None:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        if len(algorithms) == 1 and hasattr(hashlib, 'file_digest') and governor is None:
+            r = {algorithms[0]: hashlib.file_digest(f, algorithms[0]).hexdigest()}
+        else:
+            r = _read_digests(f, algorithms, size, governor)
+        if drop_cache and not was_cached:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return r
+
+def file_digests_sudo(filename, algorithms=('sha256',)):
+    '''file_digests of a file we may not read ourselves, read once through sudo cat'''
+    cmd = ['sudo', 'cat', '--', str(filename)]
+    log.debug(' '.join(cmd))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        r = _read_digests(proc.stdout, algorithms, governor=_governor.current())
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return r
+
+def file_hash(filename, drop_cache=False):
+    return file_digests(filename, ('sha256',), drop_cache)['sha256']
 
 def get_hash(s):
     h = hashlib.sha256()
@@ -71,8 +196,8 @@ def clean_glob(d: Path):
             log.warning('Cannot check %s: %s' % (child, e))
             continue
 
-def chmod(mode, path, sudo=False):
-    cmd = ['chmod', '-R', mode, str(path)]
+def chmod(mode, path, sudo=False, recursive=True):
+    cmd = ['chmod'] + (['-R'] if recursive else []) + [mode, str(path)]
     if sudo:
         cmd = ['sudo'] + cmd
     return check_call(cmd, stdout=subprocess.DEVNULL)
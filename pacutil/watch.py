@@ -0,0 +1,193 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from pathlib import Path
+
+from . import logging as log
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_event = struct.Struct('iIII')
+
+RESCAN_INTERVAL = 600
+# wait for this long without events before handing out a batch, but never longer than MAX_DELAY
+SETTLE_TIME = 0.5
+MAX_DELAY = 5
+
+
+class WatchException(Exception):
+    pass
+
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+class Inotify:
+    def __init__(self):
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise WatchException('inotify_init1: %s' % os.strerror(e))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def read(self, timeout):
+        # (wd, mask, cookie, name) of all pending events, waits at most timeout seconds
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        o = 0
+        while o < len(data):
+            wd, mask, cookie, n = _event.unpack_from(data, o)
+            o += _event.size
+            name = os.fsdecode(data[o:o + n].rstrip(b'\0'))
+            o += n
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _walk_files(d):
+    for root, dirs, files in os.walk(str(d)):
+        for f in files:
+            yield Path(root) / f
+
+
+class Watcher:
+    '''inotify watches on every directory below roots, handing out batches of touched paths
+
+    When the watch limit is exhausted, subtrees that could not be watched are rescanned
+    completely every rescan_interval seconds instead.'''
+    def __init__(self, roots, rescan_interval=RESCAN_INTERVAL):
+        self.roots = [Path(r) for r in roots]
+        self.rescan_interval = rescan_interval
+        self.inotify = Inotify()
+        self.dirs = {}
+        self.unwatched = set()
+        self.dirty = set()
+        self.dirty_since = None
+        self.last_rescan = time.monotonic()
+        for root in self.roots:
+            self.watch_tree(root)
+
+    def watch_tree(self, root, mark_dirty=False):
+        root = Path(root)
+        if not root.is_dir():
+            self.dirty.add(root)
+            return
+        for d, dirs, files in os.walk(str(root)):
+            try:
+                wd = self.inotify.add_watch(d)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    if not self.unwatched:
+                        log.warning('inotify watch limit reached, rescanning unwatched directories every %ss' % self.rescan_interval)
+                    self.unwatched.add(Path(d))
+                    dirs[:] = []
+                    if mark_dirty:
+                        self.dirty.update(_walk_files(d))
+                    continue
+                if e.errno in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                    log.warning('cannot watch %s: %s' % (d, e))
+                    dirs[:] = []
+                    continue
+                raise
+            self.dirs[wd] = Path(d)
+            if mark_dirty:
+                self.dirty.update(Path(d) / f for f in files)
+
+    def rescan_unwatched(self):
+        unwatched = self.unwatched
+        self.unwatched = set()
+        for d in unwatched:
+            # watches may have been freed in the meantime
+            self.watch_tree(d, mark_dirty=True)
+        self.last_rescan = time.monotonic()
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.warning('inotify queue overflow, rescanning everything')
+            for root in self.roots:
+                self.dirty.update(_walk_files(root))
+            return
+        d = self.dirs.get(wd)
+        if d is None:
+            return
+        if mask & IN_IGNORED:
+            del self.dirs[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return
+        p = d / name
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(p, mark_dirty=True)
+            return
+        self.dirty.add(p)
+
+    def batches(self):
+        '''yields sets of paths that were touched since the last batch'''
+        while True:
+            timeout = None
+            if self.unwatched:
+                timeout = max(0, self.last_rescan + self.rescan_interval - time.monotonic())
+            if self.dirty:
+                timeout = SETTLE_TIME if timeout is None else min(timeout, SETTLE_TIME)
+            events = self.inotify.read(timeout)
+            for wd, mask, cookie, name in events:
+                self.handle(wd, mask, name)
+            if self.unwatched and time.monotonic() - self.last_rescan >= self.rescan_interval:
+                self.rescan_unwatched()
+            if self.dirty and self.dirty_since is None:
+                self.dirty_since = time.monotonic()
+            if self.dirty and (not events or time.monotonic() - self.dirty_since >= MAX_DELAY):
+                self.dirty_since = None
+                dirty = self.dirty
+                self.dirty = set()
+                yield dirty
+
+    def close(self):
+        self.inotify.close()
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import pacutil.aur
+from pacutil.aur import AurClient, AurException, BuildCache
+from pacutil.util import file_hash
+
+
+PKGBUILD = 'pkgname=foo\npkgver=1.0\npkgrel=1\narch=(x86_64)\n'
+VCS_PKGBUILD = 'pkgname=foo-git\npkgver=1.0\npkgrel=1\narch=(x86_64)\n\npkgver() {\n  git describe\n}\n'
+
+
+def _helper_cache(tmp_path, pkgbuild, pkg_files):
+    # an AUR helper's clone, older builds are left next to the newest
+    d = tmp_path / 'yay'
+    (d / 'foo').mkdir(parents=True)
+    (d / 'foo' / 'PKGBUILD').write_text(pkgbuild)
+    for i, name in enumerate(pkg_files):
+        f = d / 'foo' / name
+        f.write_bytes(name.encode())
+        os.utime(str(f), (i, i))
+    return d, file_hash(str(d / 'foo' / 'PKGBUILD'))
+
+
+def test_helper_cache_needs_the_version(tmp_path):
+    d, pkgbuild_hash = _helper_cache(tmp_path, PKGBUILD, ['foo-1.0-1-x86_64.pkg.tar.zst', 'foo-0.9-1-x86_64.pkg.tar.zst'])
+    cache = BuildCache(tmp_path / 'builds', [d])
+    assert cache.find('foo', 'foo', '1.0-1', 'x86_64', pkgbuild_hash).name == 'foo-1.0-1-x86_64.pkg.tar.zst'
+    # the newer 0.9 file is never taken for 1.1
+    assert cache.find('foo', 'foo', '1.1-1', 'x86_64', pkgbuild_hash) is None
+
+
+def test_helper_cache_of_vcs_package(tmp_path):
+    d, pkgbuild_hash = _helper_cache(tmp_path, VCS_PKGBUILD, ['foo-1.0.r3.abc-1-x86_64.pkg.tar.zst', 'foo-1.0.r5.def-1-x86_64.pkg.tar.zst'])
+    cache = BuildCache(tmp_path / 'builds', [d])
+    p = cache.find('foo', 'foo', '1.0-1', 'x86_64', pkgbuild_hash)
+    assert p.name == 'foo-1.0.r5.def-1-x86_64.pkg.tar.zst'
+    # cached under the AUR version from now on
+    assert p == cache.find('foo', 'foo', '1.0-1', 'x86_64', pkgbuild_hash)
+
+
+class FakeAur:
+    '''the AUR's rpc info and snapshot downloads, answering conditional requests like the real one'''
+    def __init__(self):
+        self.pkgs = {}
+        self.snapshots = {}
+        self.requests = []
+
+    def add(self, pkg, version, snapshot=b'snapshot'):
+        url = '/cgit/aur.git/snapshot/%s.tar.gz' % pkg
+        self.pkgs[pkg] = dict(Name=pkg, PackageBase=pkg, Version=version, URLPath=url)
+        self.snapshots[url] = snapshot
+
+    def handler(self):
+        aur = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                aur.requests.append((self.path, self.headers.get('If-None-Match')))
+                url = urllib.parse.urlsplit(self.path)
+                if url.path == '/rpc/':
+                    query = urllib.parse.parse_qs(url.query)
+                    results = [aur.pkgs[pkg] for pkg in query['arg[]'] if pkg in aur.pkgs]
+                    body = json.dumps(dict(type='multiinfo', resultcount=len(results), results=results)).encode()
+                elif url.path in aur.snapshots:
+                    body = aur.snapshots[url.path]
+                else:
+                    self.send_error(404)
+                    return
+                etag = '"%s"' % hashlib.sha256(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        return Handler
+
+
+@pytest.fixture
+def aur():
+    aur = FakeAur()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), aur.handler())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    aur.url = 'http://127.0.0.1:%s' % server.server_port
+    yield aur
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def _closed_port_url():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%s' % s.getsockname()[1]
+
+
+def test_info_batches_by_url_length(aur, tmp_path, monkeypatch):
+    monkeypatch.setattr(pacutil.aur, 'MAX_URL_LENGTH', 300)
+    pkgs = ['package-with-a-long-name-%s' % i for i in range(20)]
+    for pkg in pkgs[::2]:
+        aur.add(pkg, '1.0-1')
+    info = AurClient(tmp_path, aur.url).info(pkgs)
+    assert sorted(info) == sorted(pkgs[::2])
+    assert len(aur.requests) > 1
+    assert all(len(aur.url + path) <= 300 for path, _ in aur.requests)
+    asked = [pkg for path, _ in aur.requests for pkg in urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)['arg[]']]
+    assert asked == pkgs
+
+
+def test_info_revalidates_and_falls_back_to_cache(aur, tmp_path):
+    aur.add('foo', '1.0-1')
+    assert AurClient(tmp_path, aur.url).info(['foo', 'bar'])['foo']['Version'] == '1.0-1'
+    # a new client revalidates the cached response, the server answers 304
+    assert AurClient(tmp_path, aur.url).info(['foo', 'bar'])['foo']['Version'] == '1.0-1'
+    assert [etag is not None for _, etag in aur.requests] == [False, True]
+    aur.add('foo', '1.1-1')
+    assert AurClient(tmp_path, aur.url).info(['foo'])['foo']['Version'] == '1.1-1'
+    # unreachable or offline, the last known info is used
+    assert AurClient(tmp_path, _closed_port_url()).info(['foo', 'bar']) == {'foo': aur.pkgs['foo']}
+    assert AurClient(tmp_path, _closed_port_url(), offline=True).pkg_info('foo')['Version'] == '1.1-1'
+    with pytest.raises(AurException):
+        AurClient(tmp_path, _closed_port_url()).pkg_info('bar')
+
+
+def test_snapshot_cached_by_version(aur, tmp_path):
+    aur.add('foo', '1.0-1', b'first')
+    client = AurClient(tmp_path, aur.url)
+    tar_file = client.snapshot('foo')
+    assert tar_file.read_bytes() == b'first'
+    # revalidated, not downloaded again
+    del aur.requests[:]
+    assert client.snapshot('foo') == tar_file
+    assert [etag is not None for _, etag in aur.requests] == [True]
+    # a new version is a new snapshot, the old one stays
+    aur.add('foo', '1.1-1', b'second')
+    client = AurClient(tmp_path, aur.url)
+    new_tar_file = client.snapshot('foo')
+    assert new_tar_file != tar_file
+    assert new_tar_file.read_bytes() == b'second' and tar_file.read_bytes() == b'first'
+    # offline, and unreachable with the info cached, the snapshot comes from the cache
+    assert AurClient(tmp_path, _closed_port_url(), offline=True).snapshot('foo') == new_tar_file
+    client.base_url = _closed_port_url()
+    assert client.snapshot('foo') == new_tar_file
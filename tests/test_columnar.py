@@ -0,0 +1,39 @@
+import hashlib
+
+import pytest
+
+from pacutil.hashcache import HashCache
+from pacutil.index import FileIndex, scan_files
+from pacutil.state import PkgState
+
+columnar = pytest.importorskip('pacutil.columnar')
+
+
+def test_batch_comparison_agrees_with_classify(tmp_path):
+    state = {}
+    installed = {}
+    files = []
+    for p in range(3):
+        pkg = 'pkg-%s' % p
+        installed[pkg] = '1.0-1'
+        expected = {}
+        for i in range(20):
+            f = tmp_path / pkg / ('file-%s' % i)
+            f.parent.mkdir(exist_ok=True)
+            f.write_text('%s %s' % (pkg, i))
+            digest = hashlib.sha256(f.read_bytes()).digest()
+            if i % 7 == 0:
+                # differs only in the last byte, or only in trailing zero bytes
+                digest = digest[:-1] + bytes([digest[-1] ^ 1]) if i else digest[:-2] + b'\0\0'
+            expected[str(f)] = digest
+            files.append(f)
+        state[pkg] = PkgState({'0.9-1': {'/usr/bin/old': b'\1' * 32}, '1.0-1': expected})
+    # the first package owning a path wins, as with the file by file comparison
+    state['pkg-2']['1.0-1'] = dict(state['pkg-2']['1.0-1'], **{str(files[1]): '0' * 64})
+    index = FileIndex(installed, installed, state, {}, {}, hash_cache=HashCache(sudo=False))
+
+    expected = scan_files(index, files)
+    comparer = columnar.BatchComparer(columnar.ColumnarState.from_index(index), batch_size=8)
+    actual = scan_files(index, files, comparer=comparer)
+    assert actual == expected
+    assert sum(map(len, expected[0].values())) == 9
@@ -0,0 +1,112 @@
+import errno
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import tempfile
+import time
+
+import pytest
+
+from pacutil import fastcopy
+
+
+# tmpfs, so the comparison with cp -a measures process overhead rather than the disk
+TMPFS = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# vfs_cap_data revision 2, effective, permitted CAP_NET_BIND_SERVICE
+CAPABILITY = struct.pack('<IIIII', 0x02000001, 1 << 10, 0, 0, 0)
+FILES = 500
+
+
+@pytest.fixture
+def tmp():
+    d = tempfile.mkdtemp(prefix='pacutil-fastcopy-', dir=TMPFS)
+    yield d
+    shutil.rmtree(d)
+
+
+def _setxattr(p, name, value):
+    try:
+        os.setxattr(p, name, value, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP):
+            return False
+        raise
+    return True
+
+
+def _xattrs(p):
+    return {n: os.getxattr(p, n, follow_symlinks=False) for n in os.listxattr(p, follow_symlinks=False)}
+
+
+def _metadata(p):
+    st = os.lstat(p)
+    return (st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns, _xattrs(p))
+
+
+def _make_tree(d):
+    os.mkdir(os.path.join(d, 'dir'))
+    f = os.path.join(d, 'dir', 'file')
+    with open(f, 'wb') as fh:
+        fh.write(os.urandom(300 * 1024))
+    os.utime(f, ns=(1000000000, 2000000000))
+    _setxattr(f, 'user.pacutil', b'value')
+    suid = os.path.join(d, 'suid')
+    with open(suid, 'wb') as fh:
+        fh.write(b'#!/bin/sh\n')
+    if os.geteuid() == 0:
+        os.chown(suid, 1234, 5678)
+    os.chmod(suid, 0o4755)
+    cap = os.path.join(d, 'cap')
+    with open(cap, 'wb') as fh:
+        fh.write(b'\x7fELF')
+    if os.geteuid() == 0:
+        os.chown(cap, 1234, 5678)
+    _setxattr(cap, 'security.capability', CAPABILITY)
+    os.symlink('dir/file', os.path.join(d, 'link'))
+    os.mkfifo(os.path.join(d, 'fifo'))
+    return ['dir/file', 'suid', 'cap', 'link', 'fifo']
+
+
+def test_preserves_metadata_like_cp(tmp):
+    src = os.path.join(tmp, 'src')
+    os.mkdir(src)
+    names = _make_tree(src)
+    ours = os.path.join(tmp, 'fastcopy')
+    cp = os.path.join(tmp, 'cp')
+    fastcopy.copy_file(src, ours)
+    subprocess.check_call(['cp', '-a', src, cp])
+    for name in names:
+        s, o, c = (os.path.join(d, name) for d in (src, ours, cp))
+        assert _metadata(o) == _metadata(s), name
+        assert _metadata(o) == _metadata(c), name
+        if stat.S_ISREG(os.lstat(s).st_mode):
+            with open(s, 'rb') as a, open(o, 'rb') as b:
+                assert a.read() == b.read(), name
+    if os.geteuid() == 0:
+        assert _xattrs(os.path.join(ours, 'cap')).get('security.capability') == CAPABILITY
+
+
+def test_files_per_second(tmp):
+    src = os.path.join(tmp, 'src')
+    os.mkdir(src)
+    for i in range(FILES):
+        with open(os.path.join(src, '%04d' % i), 'wb') as f:
+            f.write(os.urandom(4096))
+    names = sorted(os.listdir(src))
+    for d in ('fastcopy', 'cp'):
+        os.mkdir(os.path.join(tmp, d))
+
+    t = time.perf_counter()
+    fastcopy.copy_batch((os.path.join(src, n), os.path.join(tmp, 'fastcopy', n)) for n in names)
+    ours = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for n in names:
+        subprocess.check_call(['cp', '-a', os.path.join(src, n), os.path.join(tmp, 'cp', n)])
+    forked = time.perf_counter() - t
+
+    print('fastcopy %.0f files/s, cp -a per file %.0f files/s' % (FILES / ours, FILES / forked))
+    assert sorted(os.listdir(os.path.join(tmp, 'fastcopy'))) == names
+    assert ours < forked
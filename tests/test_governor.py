@@ -0,0 +1,51 @@
+import threading
+import time
+
+from pacutil import governor
+from pacutil.governor import Governor, MIN_BACKOFF
+from pacutil.util import file_digests
+
+
+THREADS = 4
+
+
+def test_every_thread_honors_a_pause(monkeypatch):
+    g = Governor(max_load=1.0, check_interval=60)
+    checks = []
+    # busy at the first check only
+    monkeypatch.setattr(g, '_overloaded', lambda: checks.append(None) or ('load' if len(checks) == 1 else None))
+    barrier = threading.Barrier(THREADS)
+    waited = []
+
+    def scan():
+        barrier.wait()
+        start = time.monotonic()
+        g.backoff()
+        waited.append(time.monotonic() - start)
+
+    threads = [threading.Thread(target=scan) for _ in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(waited) == THREADS
+    assert min(waited) > MIN_BACKOFF * 0.5
+    assert g.throttled['load'] == MIN_BACKOFF
+    assert g.pause == MIN_BACKOFF
+
+
+def test_load_limits_dont_slow_down_reads(tmp_path, monkeypatch):
+    f = tmp_path / 'f'
+    f.write_bytes(b'x' * 1024 * 1024)
+    expected = file_digests(str(f))
+    reads = []
+    for g in (Governor(max_load=100.0), Governor(max_read_rate=1024 ** 3)):
+        monkeypatch.setattr(g, 'read', lambda n: reads.append(n))
+        governor.install(g)
+        try:
+            assert file_digests(str(f)) == expected
+        finally:
+            governor.install(None)
+        reads.append(None)
+    # only the rate limited governor paces reads chunk by chunk
+    assert reads.index(None) == 0 and len(reads) > 2
@@ -0,0 +1,34 @@
+import asyncio
+import subprocess
+
+import pytest
+
+from pacutil.pacman import query_native
+
+
+def _fake_pacman(tmp_path, monkeypatch, output, status):
+    # stands in for pacman on PATH, checking that the root is passed on
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    pacman = bin_dir / 'pacman'
+    pacman.write_text('#!/bin/sh\n[ "$1 $2" = "--root %s" ] || exit 3\nprintf "%s"\nexit %s\n' % (tmp_path, output, status))
+    pacman.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:/usr/bin:/bin' % bin_dir)
+
+
+def test_native_packages(tmp_path, monkeypatch):
+    _fake_pacman(tmp_path, monkeypatch, 'bash 5.2.026-2\\nzlib 1:1.3.1-1\\n', 0)
+    assert asyncio.run(query_native(tmp_path)) == {'bash': '5.2.026-2', 'zlib': '1:1.3.1-1'}
+
+
+def test_no_native_packages_in_root(tmp_path, monkeypatch):
+    # a root without sync dbs: every package is foreign and -Qn exits 1 without output
+    _fake_pacman(tmp_path, monkeypatch, '', 1)
+    assert asyncio.run(query_native(tmp_path)) == {}
+
+
+@pytest.mark.parametrize('output, status', [('bash 5.2.026-2\\n', 1), ('', 2)])
+def test_native_packages_failure(tmp_path, monkeypatch, output, status):
+    _fake_pacman(tmp_path, monkeypatch, output, status)
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(query_native(tmp_path))
@@ -0,0 +1,61 @@
+from pathlib import Path
+
+from pacutil import hashcache
+from pacutil.hashcache import HashCache
+from pacutil.index import FileIndex, UNMODIFIED_FILE, UNCHECKABLE_FILE
+from pacutil.pacman import ConfigFilesParser, parse
+from pacutil.pacmandb import LocalDb, verify_backup_files
+from pacutil.pathindex import PathIndex
+
+
+# a local db, the system it was installed to and what pacman -Qii said about it:
+# /etc/hosts and the mirrorlist were edited, /etc/shells was deleted
+DATA = Path(__file__).parent / 'data' / 'backup-parity'
+
+
+def _load(tmp_path):
+    return LocalDb(tmp_path / 'pacmandb', DATA / 'local').load()
+
+
+def _flatten(config_files):
+    return sorted((pkg, version, changed, f) for pkg, versions in config_files.items()
+                  for version, fs in versions.items() for changed, f in fs)
+
+
+def test_backup_files_verify_like_pacman_qii(tmp_path):
+    expected = parse(ConfigFilesParser(), (DATA / 'pacman-Qii.txt').read_text()).result()
+    actual = verify_backup_files(_load(tmp_path).backup_files(), DATA / 'root', HashCache(sudo=False))
+    assert _flatten(actual) == _flatten(expected)
+    assert len(_flatten(expected)) == 4
+
+
+def test_index_verifies_backup_files_while_hashing(tmp_path, monkeypatch):
+    db = _load(tmp_path)
+    expected = _flatten(parse(ConfigFilesParser(), (DATA / 'pacman-Qii.txt').read_text()).result())
+    # the state knows /etc/fstab too, both its digests come from one read
+    fstab = DATA / 'root' / 'etc' / 'fstab'
+    state = {'filesystem': {'2024.04.07-1': {'/etc/fstab': hashcache.file_digests(str(fstab), ('sha256',))['sha256']}}}
+    reads = []
+    file_digests = hashcache.file_digests
+    monkeypatch.setattr(hashcache, 'file_digests', lambda path, *args: reads.append(path) or file_digests(path, *args))
+    index = FileIndex(db.installed_pkgs(), db.installed_pkgs(), state, db.backup_files(), db.owned_files(),
+                      hash_cache=HashCache(sudo=False), root=DATA / 'root')
+
+    actual = sorted((pkg, version, index.config_status(f), f) for pkg, version, _, f in expected)
+    assert actual == expected
+    assert index.classify('/etc/fstab').cls == UNMODIFIED_FILE
+    assert index.config_status('/etc/shells') is None
+    assert sorted(reads) == sorted(str(DATA / 'root' / f.lstrip('/')) for _, _, _, f in expected)
+
+
+def test_path_index_verifies_backup_files(tmp_path):
+    db = _load(tmp_path)
+    index = FileIndex(db.installed_pkgs(), db.installed_pkgs(), {}, db.backup_files(), db.owned_files(),
+                      hash_cache=HashCache(sudo=False))
+    path_index = PathIndex(tmp_path / 'pathindex.sqlite')
+    path_index.rebuild(index, 'test')
+    # the index holds the paths of the installed system, move them below the fixture's root
+    path_index.db.execute('update files set path = ? || path', (str(DATA / 'root'),))
+    classify = lambda f: path_index.classify(str(DATA / 'root' / f), (), HashCache(sudo=False).digests)
+    assert classify('etc/pacman.conf').cls == UNMODIFIED_FILE
+    assert classify('etc/hosts').cls == UNCHECKABLE_FILE
@@ -0,0 +1,96 @@
+import shutil
+import subprocess
+
+from pathlib import Path
+
+import pytest
+
+from pacutil.pkgrepo import PkgRepo, PkgRepoException, share_working_copies, collect_share_tags, tag_name
+
+
+pytestmark = pytest.mark.skipif(shutil.which('hg') is None, reason='needs mercurial')
+
+
+def _repo(path):
+    subprocess.check_call(['hg', 'init', str(path)])
+    (path / '.hg' / 'hgrc').write_text('[ui]\nusername = test\n')
+    return PkgRepo(str(path))
+
+
+def _commit(repo, files, msg):
+    for rel, content in files.items():
+        p = Path(repo.repo_path) / rel
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(content)
+    repo.add(*files)
+    repo.commit(m=msg)
+
+
+def test_branch_manifests(tmp_path):
+    repo = _repo(tmp_path / 'repo')
+    _commit(repo, {'etc/a': 'a'}, 'initial')
+    repo.branch('pkg')
+    _commit(repo, {'etc/pkg.conf': 'pkg'}, 'pkg')
+    repo.update('default')
+    _commit(repo, {'etc/b': 'b'}, 'default')
+    repo.branch('closed')
+    _commit(repo, {'etc/closed': 'c'}, 'closed')
+    repo.commit(m='close', **{'close-branch': True})
+
+    assert repo.branch_manifests() == {'default': {'etc/a', 'etc/b'}, 'pkg': {'etc/a', 'etc/pkg.conf'}}
+
+
+def test_files_differ(tmp_path):
+    live = tmp_path / 'live.conf'
+    live.write_text('x')
+    rel = str(live.relative_to('/'))
+    repo = PkgRepo(str(tmp_path / 'repo'))
+    assert not repo.files_differ([str(live)], {rel})
+    # not tracked yet
+    assert repo.files_differ([str(live)], set())
+    # tracked but removed from the system
+    assert repo.files_differ([], {rel, str((tmp_path / 'gone').relative_to('/'))})
+
+
+def _stage(share, pkg, version):
+    # what check-files does in a worker's working copy
+    share.ensure_branch(pkg, from_branch='default', commit=False, clean=True)
+    f = Path(share.repo_path) / 'etc' / (pkg + '.conf')
+    f.parent.mkdir(exist_ok=True)
+    f.write_text(version)
+    share.commit_and_tag([str(f)], '%s %s' % (pkg, version), tag_name(pkg, version))
+
+
+def test_tags_set_in_two_shares_are_collected(tmp_path):
+    repo = _repo(tmp_path / 'repo')
+    _commit(repo, {'etc/a': 'a'}, 'initial')
+    shares = list(share_working_copies(repo, 2, tmp_path / 'shares'))
+    for share in shares:
+        (Path(share.repo_path) / '.hg' / 'hgrc').write_text('[ui]\nusername = test\n')
+    _stage(shares[0], 'foo', '1:1.0-1')
+    _stage(shares[1], 'bar', '2.0-1')
+
+    collect_share_tags(repo, shares)
+    tags = dict(t.split()[:2] for t in repo.tags())
+    assert {tag_name('foo', '1:1.0-1'), tag_name('bar', '2.0-1')} <= set(tags)
+    assert repo.make_command('log')(r=tag_name('bar', '2.0-1'), T='{branch}') == 'bar'
+    assert not any((Path(share.repo_path) / '.hg' / 'localtags').exists() for share in shares)
+    # a share left with tags by a crashed run hands them over when it is reused
+    _stage(shares[0], 'foo', '1:1.1-1')
+    list(share_working_copies(repo, 2, tmp_path / 'shares'))
+    assert tag_name('foo', '1:1.1-1') in set(t.split()[0] for t in repo.tags())
+
+
+def test_tags_on_the_wrong_branch_are_reported(tmp_path):
+    repo = _repo(tmp_path / 'repo')
+    _commit(repo, {'etc/a': 'a'}, 'initial')
+    share, = share_working_copies(repo, 1, tmp_path / 'shares')
+    (Path(share.repo_path) / '.hg' / 'hgrc').write_text('[ui]\nusername = test\n')
+    _stage(share, 'foo', '1.0-1')
+    node = repo.make_command('log')(r='default', T='{node}')
+    with (Path(share.repo_path) / '.hg' / 'localtags').open('a') as f:
+        f.write('%s %s\n' % (node, tag_name('bar', '1.0-1')))
+
+    with pytest.raises(PkgRepoException, match='bar#1.0-1'):
+        collect_share_tags(repo, [share])
+    assert tag_name('foo', '1.0-1') in set(t.split()[0] for t in repo.tags())
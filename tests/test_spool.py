@@ -0,0 +1,84 @@
+import json
+import multiprocessing
+import os
+import time
+
+from pacutil.spool import Spool, work, CLAIMED, HEARTBEATS, PENDING, DONE, CLAIM_SEP
+
+
+JOBS = 40
+WORKERS = 4
+CRASHING_JOB = 'pkg-7'
+
+
+def _run_job(results, job):
+    if job['pkg'] == CRASHING_JOB:
+        try:
+            # crash the first worker getting this job, while it holds the claim
+            os.close(os.open(os.path.join(results, 'crashed'), os.O_CREAT | os.O_EXCL))
+            os._exit(1)
+        except FileExistsError:
+            pass
+    # O_EXCL, a job run twice fails here
+    os.close(os.open(os.path.join(results, job['pkg']), os.O_CREAT | os.O_EXCL))
+    time.sleep(0.01)
+    return dict(worker=os.getpid())
+
+
+def _worker(spool_path, results):
+    work(Spool(spool_path), lambda job: _run_job(results, job), heartbeat_interval=0.1)
+
+
+def _claim_as(spool, name, owner):
+    # a claim as made by a worker on another host
+    claimed = spool.path / CLAIMED / (name + CLAIM_SEP + owner)
+    os.rename(str(spool.path / PENDING / name), str(claimed))
+    (spool.path / HEARTBEATS / claimed.name).write_text('0')
+    return claimed
+
+
+def test_workers_share_the_queue_and_recover_crashed_claims(tmp_path):
+    spool = Spool(tmp_path / 'spool')
+    results = tmp_path / 'results'
+    results.mkdir()
+    for i in range(JOBS):
+        assert spool.enqueue('pkg-%s' % i, '1.0-1', dict(arch='x86_64'))
+    assert not spool.enqueue('pkg-0', '1.0-1', dict(arch='x86_64'))
+
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_worker, args=(str(spool.path), str(results))) for _ in range(WORKERS)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(60)
+    # the crashed worker's claim goes back to the queue as soon as a worker on this host looks
+    done, failed = work(spool, lambda job: _run_job(str(results), job))
+
+    assert failed == 0
+    assert spool.counts() == {PENDING: 0, CLAIMED: 0, DONE: JOBS, 'failed': 0}
+    assert sorted(os.listdir(str(results))) == sorted(['crashed'] + ['pkg-%s' % i for i in range(JOBS)])
+    workers_used = set(json.loads((spool.path / DONE / n).read_text())['result']['worker'] for n in os.listdir(str(spool.path / DONE)))
+    assert len(workers_used) > 1
+
+
+def test_stale_claims_are_timed_by_heartbeat_not_clocks(tmp_path):
+    spool = Spool(tmp_path / 'spool', stale_after=0.3)
+    spool.enqueue('alive', '1', {})
+    spool.enqueue('dead', '1', {})
+    alive = _claim_as(spool, 'alive 1', 'otherhost:1')
+    dead = _claim_as(spool, 'dead 1', 'otherhost:2')
+    # the other host's clock is way off, in both directions
+    os.utime(str(alive), (0, 0))
+    os.utime(str(dead), (time.time() + 86400,) * 2)
+
+    assert spool.recover_stale() == []
+    for beat in range(1, 4):
+        time.sleep(0.15)
+        (spool.path / HEARTBEATS / alive.name).write_text(str(beat))
+        recovered = spool.recover_stale()
+        if recovered:
+            break
+    assert recovered == ['dead 1']
+    assert alive.exists()
+    assert (spool.path / PENDING / 'dead 1').exists()
+    assert not (spool.path / HEARTBEATS / dead.name).exists()
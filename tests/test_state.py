@@ -0,0 +1,74 @@
+import pytest
+
+from pacutil.state import KEYFRAME_EVERY, PkgState, StateFormatException, gc_state, load_pkg_state, save_state
+
+
+def _files(i):
+    # every version changes, adds and removes some files, /etc/foo.conf never changes, only the first has /opt
+    files = {'/etc/foo.conf': '0' * 64, '/usr/bin/foo': '%064x' % i}
+    files.update(('/usr/share/foo/%s' % j, '%064x' % (i * 100 + j)) for j in range(i % 5, i % 5 + 3))
+    if i == 0:
+        files['/opt/foo/legacy'] = 'a' * 64
+    return files
+
+
+def _versions(n):
+    return {'1.%s-1' % i: _files(i) for i in range(n)}
+
+
+def test_round_trip_across_keyframes(tmp_path):
+    versions = _versions(40)
+    assert len(versions) > 2 * KEYFRAME_EVERY
+    pkg_state = PkgState(versions)
+    save_state({'foo': pkg_state}, tmp_path)
+    loaded = load_pkg_state(tmp_path / 'foo.pstate')
+    assert list(loaded) == list(versions)
+    assert {v: loaded[v] for v in loaded} == versions
+    assert loaded.to_bytes() == pkg_state.to_bytes()
+
+
+def test_delete_and_compact():
+    versions = _versions(40)
+    pkg_state = PkgState(versions)
+    # deleting bases of other versions and keyframes alike
+    for version in ['1.0-1', '1.%s-1' % KEYFRAME_EVERY, '1.17-1', '1.39-1']:
+        del pkg_state[version]
+        del versions[version]
+    assert {v: pkg_state[v] for v in pkg_state} == versions
+    nodes = len(pkg_state.paths.nodes)
+    pkg_state.compact()
+    assert len(pkg_state.paths.nodes) < nodes
+    assert {v: pkg_state[v] for v in pkg_state} == versions
+    assert {v: pkg_state[v] for v in pkg_state} == {v: fs for v, fs in PkgState.from_bytes(pkg_state.to_bytes()).items()}
+    with pytest.raises(KeyError):
+        del pkg_state['1.0-1']
+
+
+def test_reassign_version():
+    versions = _versions(20)
+    pkg_state = PkgState(versions)
+    # a version in the middle of a delta chain, later versions are deltas against it
+    versions['1.5-1'] = dict(_files(5), **{'/usr/bin/foo': 'f' * 64, '/usr/bin/bar': 'e' * 64})
+    pkg_state['1.5-1'] = versions['1.5-1']
+    assert list(pkg_state) == list(versions)
+    assert {v: pkg_state[v] for v in pkg_state} == versions
+    assert {v: fs for v, fs in PkgState.from_bytes(pkg_state.to_bytes()).items()} == versions
+
+
+def test_truncated_state():
+    b = PkgState(_versions(3)).to_bytes()
+    for n in (5, 12, len(b) // 2, len(b) - 1):
+        with pytest.raises(StateFormatException):
+            PkgState.from_bytes(b[:n])
+    with pytest.raises(StateFormatException):
+        PkgState.from_bytes(b'JSON' + b[4:])
+
+
+def test_gc_state():
+    state = {'foo': PkgState(_versions(40)), 'bar': PkgState(_versions(2))}
+    keep = {'foo': {'1.3-1', '1.30-1'}}
+    dropped = gc_state(state, keep)
+    assert sorted(dropped) == sorted([('foo', v) for v in _versions(40) if v not in keep['foo']] + [('bar', v) for v in _versions(2)])
+    assert list(state['foo']) == ['1.3-1', '1.30-1']
+    assert state['foo']['1.30-1'] == _files(30)
+    assert not state['bar']
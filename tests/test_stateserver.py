@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pacutil.stateserver import StateClient, StateStore, make_server
+
+
+ARCH = 'x86_64'
+TOKEN = 'secret'
+FILES = {'/etc/foo.conf': '0' * 64, '/usr/bin/foo': '1' * 64}
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = make_server(tmp_path / 'store', port=0, token=TOKEN)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def _url(server):
+    return 'http://127.0.0.1:%s' % server.server_port
+
+
+def _client(server, tmp_path, name='client', token=TOKEN):
+    return StateClient(_url(server), tmp_path / name, ARCH, batch_size=2, token=token)
+
+
+def _get(server, path, headers={}):
+    req = urllib.request.Request(_url(server) + path, headers=dict(headers, Authorization='Bearer %s' % TOKEN))
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, resp.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get('ETag')
+
+
+def test_upload_fetch_and_revalidate(server, tmp_path):
+    a = _client(server, tmp_path, 'a')
+    assert a.upload('foo', '1.0-1', FILES)
+    # the same entry again is fine, a different one is refused
+    assert a.upload('foo', '1.0-1', FILES)
+    assert not a.upload('foo', '1.0-1', dict(FILES, **{'/etc/foo.conf': '2' * 64}))
+
+    b = _client(server, tmp_path, 'b')
+    wanted = [('foo', '1.0-1'), ('foo', '2.0-1'), ('bar', '1')]
+    assert b.fetch(wanted) == {('foo', '1.0-1'): FILES}
+    # known entries are only revalidated, and still there when the server is gone
+    assert b.fetch(wanted) == {('foo', '1.0-1'): FILES}
+    server.shutdown()
+    server.server_close()
+    assert b.fetch(wanted) == {('foo', '1.0-1'): FILES}
+
+
+def test_conditional_get(server, tmp_path):
+    assert _client(server, tmp_path).upload('foo', '1.0-1', FILES)
+    code, etag = _get(server, '/state/%s/foo/1.0-1' % ARCH)
+    assert code == 200
+    assert _get(server, '/state/%s/foo/1.0-1' % ARCH, {'If-None-Match': etag}) == (304, etag)
+    assert _get(server, '/state/%s/foo/2.0-1' % ARCH)[0] == 404
+    assert _get(server, '/state/%s/foo/..' % ARCH)[0] == 400
+
+
+def test_token_is_required(server, tmp_path):
+    assert not _client(server, tmp_path, token=None).upload('foo', '1.0-1', FILES)
+    assert not _client(server, tmp_path, token='wrong').upload('foo', '1.0-1', FILES)
+    assert _client(server, tmp_path, 'c').fetch([('foo', '1.0-1')]) == {}
+
+
+def test_first_concurrent_upload_wins(server, tmp_path, monkeypatch):
+    get = StateStore.get
+    # widen the window between looking for an entry and writing it
+    monkeypatch.setattr(StateStore, 'get', lambda *args: (get(*args), time.sleep(0.02))[0])
+    uploads = [{'/etc/foo.conf': '%x' % i * 64} for i in range(16)]
+    client = _client(server, tmp_path)
+    with ThreadPoolExecutor(len(uploads)) as executor:
+        stored = list(executor.map(lambda files: client.upload('foo', '1.0-1', files), uploads))
+    assert stored.count(True) == 1
+    winner = uploads[stored.index(True)]
+    assert _client(server, tmp_path, 'd').fetch([('foo', '1.0-1')]) == {('foo', '1.0-1'): winner}
+    entry = next((tmp_path / 'store').rglob('*.json'))
+    assert json.loads(entry.read_text()) == winner
+    assert [p.name for p in entry.parent.iterdir()] == [entry.name]
@@ -1,6 +1,6 @@
-import pkg_resources
-
 def earlier_version(a, b):
+    # pkg_resources is slow to import, only pay for it when comparing versions
+    import pkg_resources
     v = pkg_resources.parse_version
     # parse_version doesn't really support '+' (1.0+1 < 1.0-1)
     if '+' in a or '+' in b: